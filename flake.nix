@@ -36,6 +36,8 @@
               # mesh-python
               python313Packages.meshtastic
               python313Packages.cryptography
+              python313Packages.numpy
+              python313Packages.orjson
               python313Packages.fastapi
               fastapi-cli
               sillyORM.packages.${system}.default
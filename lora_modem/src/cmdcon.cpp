@@ -35,6 +35,19 @@ public:
     size_t write(const uint8_t* buf, size_t size) override { return size; }
 } dummyStream;
 
+static int hex_nibble(char c) {
+    if (c >= '0' && c <= '9') {
+        return c - '0';
+    }
+    if (c >= 'a' && c <= 'f') {
+        return c - 'a' + 10;
+    }
+    if (c >= 'A' && c <= 'F') {
+        return c - 'A' + 10;
+    }
+    return -1;
+}
+
 void CMDCon::set_stream(Stream *s, void (*unset_cb)()) {
     if (this->stream == s) {
         return;
@@ -54,6 +67,8 @@ void CMDCon::set_stream(Stream *s, void (*unset_cb)()) {
         this->stream = &dummyStream;
     }
     this->stream_unset_cb = unset_cb;
+    // new connection, the host has to negotiate the encoding again
+    this->hex_data = false;
     radio->onReceive(rx_hook);
     radio->modeStandby();
     this->is_stby = true;
@@ -100,6 +115,7 @@ void CMDCon::process() {
                 LOG_DEBUG("settings: set txPower");
                 unsigned short txPower = doc["txPower"];
                 if (radio->setTxPower(txPower)) {
+                    this->tx_power = txPower;
                     docOut["txPower"] = txPower;
                 }
             }
@@ -189,6 +205,18 @@ void CMDCon::process() {
                 }
             }
 
+            if (doc["dataEncoding"].is<const char *>()) {
+                LOG_DEBUG("settings: set dataEncoding");
+                const char *dataEncoding = doc["dataEncoding"].as<const char *>();
+                if (strcmp(dataEncoding, "hex") == 0) {
+                    this->hex_data = true;
+                    docOut["dataEncoding"] = "hex";
+                } else if (strcmp(dataEncoding, "list") == 0) {
+                    this->hex_data = false;
+                    docOut["dataEncoding"] = "list";
+                }
+            }
+
             if (doc["wifi"].is<JsonObject>() && doc["wifi"]["ssid"].is<const char *>() && doc["wifi"]["password"].is<const char *>()) {
                 LOG_DEBUG("settings: got wifi SSID: %s and password", doc["wifi"]["ssid"].as<const char *>());
                 config_set_wifi(doc["wifi"]["ssid"], doc["wifi"]["password"]);
@@ -204,27 +232,53 @@ void CMDCon::process() {
             docOut["type"] = "meta";
             docOut["gainMax"] = radio->getGainMax();
             docOut["txPowerMax"] = radio->getTxPowerMax();
+            JsonArray dataEncodings = docOut["dataEncodings"].to<JsonArray>();
+            dataEncodings.add("list");
+            dataEncodings.add("hex");
+            docOut["perFrameTxPower"] = true;
             serializeJson(docOut, *this->stream);
             this->stream->println();
         } else if (type == "packetTx") {
-            JsonArray data = doc["data"].as<JsonArray>();
             bool cad = doc["cad"].is<bool>() && doc["cad"].as<bool>();
             unsigned long cad_wait = doc["cadWait"].is<unsigned long>() ? doc["cadWait"].as<unsigned long>() : 1;
             unsigned long cad_timeout = doc["cadTimeout"].is<unsigned long>() ? doc["cadTimeout"].as<unsigned long>() : 1;
-            size_t buf_size = data.size();
-            if (buf_size == 0) {
-                return;
-            }
-            LOG_DEBUG("transmitting packet with size %zu", buf_size);
-            uint8_t *buf = new uint8_t[buf_size];
-            size_t buf_idx = 0;
-            for (JsonVariant v : data) {
-                if (!v.is<unsigned int>()) {
-                    delete buf;
+            size_t buf_size;
+            uint8_t *buf;
+            if (doc["data"].is<const char *>()) {
+                // hex string
+                const char *hex = doc["data"].as<const char *>();
+                size_t hex_len = strlen(hex);
+                if (hex_len == 0 || hex_len % 2 != 0) {
+                    return;
+                }
+                buf_size = hex_len / 2;
+                buf = new uint8_t[buf_size];
+                for (size_t i = 0; i < buf_size; i++) {
+                    int hi = hex_nibble(hex[i * 2]);
+                    int lo = hex_nibble(hex[(i * 2) + 1]);
+                    if (hi < 0 || lo < 0) {
+                        delete[] buf;
+                        return;
+                    }
+                    buf[i] = (hi << 4) | lo;
+                }
+            } else {
+                JsonArray data = doc["data"].as<JsonArray>();
+                buf_size = data.size();
+                if (buf_size == 0) {
                     return;
                 }
-                buf[buf_idx++] = v.as<unsigned int>();
+                buf = new uint8_t[buf_size];
+                size_t buf_idx = 0;
+                for (JsonVariant v : data) {
+                    if (!v.is<unsigned int>()) {
+                        delete[] buf;
+                        return;
+                    }
+                    buf[buf_idx++] = v.as<unsigned int>();
+                }
             }
+            LOG_DEBUG("transmitting packet with size %zu", buf_size);
 
 #ifdef HAS_LED
             digitalWrite(LED_PIN, HIGH);
@@ -234,7 +288,24 @@ void CMDCon::process() {
             bool tx_allowed = true;
             bool tx_success = false;
 
-            if (cad) {
+            // per-frame TX power, restored after this frame
+            bool tx_power_override = false;
+            if (doc["txPower"].is<unsigned short>() && this->tx_power < 0) {
+                // no default to restore afterwards, the override would stick for every later frame
+                tx_allowed = false;
+                reason = "txPowerNoDefault";
+                LOG_DEBUG(reason);
+            } else if (doc["txPower"].is<unsigned short>()) {
+                unsigned short txPower = doc["txPower"].as<unsigned short>();
+                if (radio->setTxPower(txPower)) {
+                    tx_power_override = true;
+                } else {
+                    tx_allowed = false;
+                    reason = "setTxPower failed";
+                }
+            }
+
+            if (tx_allowed && cad) {
                 LOG_DEBUG("waiting for channel to become inactive");
                 unsigned long tstart = millis();
                 while (radio->isChannelActive()) {
@@ -242,6 +313,7 @@ void CMDCon::process() {
                         tx_allowed = false;
                         reason = "cadTimeout";
                         LOG_DEBUG(reason);
+                        break;
                     }
 
                     // busy. Receive and wait for cad_wait ms
@@ -264,12 +336,16 @@ void CMDCon::process() {
                     reason = "endPacket failed";
                     LOG_DEBUG(reason);
                 }
-            } else {
+            } else if (tx_allowed) {
                 reason = "beginPacket failed";
                 LOG_DEBUG(reason);
             }
 
-            delete buf;
+            delete[] buf;
+
+            if (tx_power_override) {
+                radio->setTxPower(this->tx_power);
+            }
             
             LOG_DEBUG("setting radio mode back");
             set_rx_mode();
@@ -300,10 +376,20 @@ void CMDCon::dump_packets() {
         doc["rssi"] = p->rssi;
         doc["snr"] = p->snr;
         doc["freqError"] = p->freqError;
-        JsonArray arr = doc["data"].to<JsonArray>();
-        // FIXME: improve perf
-        for (size_t i = 0; i < p->plen; i++) {
-            arr.add(p->data[i]);
+        if (this->hex_data) {
+            static const char hex_chars[] = "0123456789abcdef";
+            char hex[(MAX_PACKET_LEN * 2) + 1];
+            for (size_t i = 0; i < p->plen; i++) {
+                hex[i * 2] = hex_chars[p->data[i] >> 4];
+                hex[(i * 2) + 1] = hex_chars[p->data[i] & 0xF];
+            }
+            hex[p->plen * 2] = '\0';
+            doc["data"] = hex;
+        } else {
+            JsonArray arr = doc["data"].to<JsonArray>();
+            for (size_t i = 0; i < p->plen; i++) {
+                arr.add(p->data[i]);
+            }
         }
         serializeJson(doc, *this->stream);
         this->stream->println();
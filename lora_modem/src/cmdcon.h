@@ -29,6 +29,10 @@ private:
     static void rx_hook(size_t psize);
     void set_rx_mode();
     unsigned long prev_telem = 0;
+    // packet data as hex strings instead of JSON arrays, negotiated by the host with the dataEncoding setting
+    bool hex_data = false;
+    // TX power from the settings, packetTx may override it for a single frame
+    int tx_power = -1;
 };
 
 extern CMDCon CMDConGlobal;
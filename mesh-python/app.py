@@ -8,6 +8,7 @@ import pydantic
 import sillyorm
 from . import orm
 from .meshcore import api as meshcore_api
+from .meshtastic_proto import api as meshtastic_api
 from . import esplora
 
 _active_protos = {}
@@ -157,6 +158,8 @@ class LoraModem(sillyorm.model.Model):
     # lora settings
     lora_gain = sillyorm.fields.Integer(required=True, default=0)
     lora_tx_power = sillyorm.fields.Integer(required=True, default=0)
+    # maximum TX duty cycle (0-1) within one hour, e.g. 0.1 for the EU868 869.4-869.65MHz sub-band
+    lora_tx_duty_cycle = sillyorm.fields.Float()
 
     @sillyorm.model.constraints("proto_model", "proto_id")
     def _proto_link_check(self):
@@ -168,13 +171,15 @@ class LoraModem(sillyorm.model.Model):
             if record.proto_model is not None and record.env[record.proto_model].browse(record.proto_id).modem_id.id != self.id:
                 raise Exception("linked proto record does not point to modem")
 
-    @sillyorm.model.constraints("lora_gain", "lora_tx_power")
+    @sillyorm.model.constraints("lora_gain", "lora_tx_power", "lora_tx_duty_cycle")
     def _check_lora_settings(self):
         for record in self:
             if record.lora_gain < 0 or record.lora_gain > 10:
                 raise Exception(f"invalid lora_gain {record.lora_gain}")
             if record.lora_tx_power < 0:
                 raise Exception(f"invalid lora_tx_power {record.lora_tx_power}")
+            if record.lora_tx_duty_cycle is not None and (record.lora_tx_duty_cycle <= 0 or record.lora_tx_duty_cycle > 1):
+                raise Exception(f"invalid lora_tx_duty_cycle {record.lora_tx_duty_cycle}")
 
     def proto_link(self, proto):
         self.ensure_one()
@@ -221,6 +226,7 @@ class LoraModem(sillyorm.model.Model):
 
         inst.set_gain(self.lora_gain)
         inst.set_tx_power(self.lora_tx_power)
+        inst.set_duty_cycle_budget(self.lora_tx_duty_cycle)
 
         return inst
 
@@ -232,6 +238,7 @@ logging.basicConfig(
 async def lifespan(app: fastapi.FastAPI):
     orm.init()
     meshcore_api.startup()
+    meshtastic_api.startup()
     yield
     ProtoCommon.stop_all_protos()
 
@@ -248,3 +255,4 @@ app.add_middleware(
 )
 
 app.include_router(meshcore_api.routes.router.router, prefix="/meshcore")
+app.include_router(meshtastic_api.routes.router.router, prefix="/meshtastic")
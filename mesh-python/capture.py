@@ -0,0 +1,166 @@
+import array
+import dataclasses
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from . import lora_modem
+
+_logger = logging.getLogger(__name__)
+
+# File layout (all little endian):
+#   header: magic, format version, creation time
+#   records: record header followed by data_len bytes of packet data, appended one after another
+# The offsets of all records are kept in a sidecar <path>.idx file as u64 values so readers can seek
+# to any record directly. If the index is missing or shorter than the capture (e.g. after a crash)
+# the missing part is rebuilt by scanning the capture.
+MAGIC = b"LORACAP\x00"
+VERSION = 1
+HEADER = struct.Struct("<8sHxxxxxxd")
+# data_len, timestamp, snr, rssi, freqError, frequency, bandwidth, spreading_factor, coding_rate, preamble_length, flags
+RECORD = struct.Struct("<HdfhiIIBBHB")
+INDEX_ENTRY = struct.Struct("<Q")
+
+FLAG_CRC = 0x1
+FLAG_LDRO = 0x2
+
+
+@dataclasses.dataclass
+class CaptureRecord:
+    timestamp: float # unix time the packet was received at
+    packet: lora_modem.LoraPacketReceived
+    frequency: int | None
+    bandwidth: int | None
+    spreading_factor: int | None
+    coding_rate: int | None
+    preamble_length: int | None
+    crc: bool
+    low_data_rate_optimize: bool
+
+
+class CaptureWriter:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._file = open(path, "ab")
+        self._index = open(path + ".idx", "ab")
+        if self._file.tell() == 0:
+            self._file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+            self._file.flush()
+
+    def write(self, p: lora_modem.LoraPacketReceived, params: dict, timestamp: float | None = None) -> None:
+        """
+        append a packet, params is a dict with the modem settings (see LoraModem.get_lora_params)
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        flags = (FLAG_CRC if params.get("crc") else 0) | (FLAG_LDRO if params.get("low_data_rate_optimize") else 0)
+        record = RECORD.pack(
+            len(p.data),
+            timestamp,
+            p.snr,
+            p.rssi,
+            p.freqError,
+            params.get("frequency") or 0,
+            params.get("bandwidth") or 0,
+            params.get("spreading_factor") or 0,
+            params.get("coding_rate") or 0,
+            params.get("preamble_length") or 0,
+            flags,
+        )
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(record + bytes(p.data))
+            self._file.flush()
+            self._index.write(INDEX_ENTRY.pack(offset))
+            self._index.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+            self._index.close()
+
+
+class CaptureReader:
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.created = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise Exception(f"{path} is not a capture file")
+        if version != VERSION:
+            raise Exception(f"unsupported capture version {version}")
+        self._offsets = self._load_index(path + ".idx")
+
+    def _load_index(self, path: str) -> array.array:
+        offsets = array.array("Q")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                raw = f.read()
+            # ignore a torn trailing entry
+            offsets.frombytes(raw[:len(raw) - (len(raw) % INDEX_ENTRY.size)])
+        # rebuild whatever is missing from the index
+        offset = HEADER.size
+        if offsets:
+            offset = offsets[-1] + RECORD.size + RECORD.unpack_from(self._mm, offsets[-1])[0]
+        while offset + RECORD.size <= len(self._mm):
+            data_len = RECORD.unpack_from(self._mm, offset)[0]
+            if offset + RECORD.size + data_len > len(self._mm):
+                break
+            offsets.append(offset)
+            offset += RECORD.size + data_len
+        return offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, i: int) -> CaptureRecord:
+        offset = self._offsets[i]
+        data_len, timestamp, snr, rssi, freq_error, frequency, bandwidth, spreading_factor, coding_rate, preamble_length, flags = RECORD.unpack_from(self._mm, offset)
+        data_start = offset + RECORD.size
+        return CaptureRecord(
+            timestamp=timestamp,
+            packet=lora_modem.LoraPacketReceived(
+                data=self._mm[data_start:data_start + data_len],
+                snr=snr,
+                rssi=rssi,
+                freqError=freq_error,
+            ),
+            frequency=frequency or None,
+            bandwidth=bandwidth or None,
+            spreading_factor=spreading_factor or None,
+            coding_rate=coding_rate or None,
+            preamble_length=preamble_length or None,
+            crc=bool(flags & FLAG_CRC),
+            low_data_rate_optimize=bool(flags & FLAG_LDRO),
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def replay(self, rx_cb, speed: float | None = 1.0, should_run_fn=lambda: True) -> None:
+        """
+        Feed every packet to rx_cb (the same callback you would pass to LoraModem.start).
+        speed is the time scaling (1.0 = original timing, 10.0 = ten times as fast), None replays as fast as possible.
+        """
+        t_start = time.monotonic()
+        t_first = None
+        for record in self:
+            if not should_run_fn():
+                return
+            if speed is not None:
+                if t_first is None:
+                    t_first = record.timestamp
+                wait = ((record.timestamp - t_first) / speed) - (time.monotonic() - t_start)
+                if wait > 0:
+                    time.sleep(wait)
+            try:
+                rx_cb(record.packet)
+            except:
+                _logger.exception("rx_cb exception")
+
+    def close(self) -> None:
+        self._mm.close()
+        self._file.close()
@@ -2,53 +2,69 @@
 # while [ true ]; do python -m mesh-python.dev 2>&1 | tee -a mesh-python/mesh-python.log; done
 import time
 import json
+import random
+import tracemalloc
 import logging
 from . import esplora
+from . import esplora_sim
+from . import capture
 from . import meshtastic_dm
 from . import lora_modem
 from . import meshcore
+from . import virtual_lora
 
 _logger = logging.getLogger(__name__)
 
+MESHCORE_SAMPLE_PACKETS = [
+    # group msg in #test
+    "150D498F8642DE3C33CCAB4EBAA028D937E5DB6B97E1D456C81BCE119EA8DAF177E7D3FCE230EF298C56C2E06C942D1506E4D45D09846BB525FD3D5673B39660F94AFAEBF3CC70BE2C680ABD1C85A2BD643F44949B9748CC80228B6F4F79AABDB2AB8104882BD70367DD24CDD6D091A1B506",
+    # advert with location
+    "120056CBB26E9DE37E150F9FD087E01D266C21D30088A8C2DBDEFF4E6005726A796FB0D18569EEB69315DDBCFCBEAE402E09AFC9946F3F8BDE8A0477E9AB157865987D78BB1B3F55999C1107830375E5F6C904D5F81FE0A766A260B31BA53EFD03D1E54BFB05925AE739035A6C8F004D757368726F6F6D20F09F8D84202874656D7029",
+    # trace
+    "260334F6E3AA57517E0000000000D026B326D0",
+]
+
 def meshtastic_stuff(esplora_inst):
     # channels.json is a list of objects with the keys name and psk
     with open("mesh-python/channels.json") as f:
         channels_json = json.loads(f.read())
 
+    # LongFast EU_868
+    with esplora_inst.settings():
+        esplora_inst.set_frequency(869525000)
+        esplora_inst.set_spreading_factor(11)
+        esplora_inst.set_bandwidth(250000)
+        esplora_inst.set_coding_rate(5)
     meshtastic_inst = meshtastic_dm.Meshtastic(esplora_inst, channels_json)
     meshtastic_inst.start()
 
-def meshcore_stuff(esplora_inst):
+def meshcore_stuff(esplora_inst, **kwargs):
     node = meshcore.meshcore.MeshcoreNode()
-    pkts = [
-        # group msg in #test
-        "150D498F8642DE3C33CCAB4EBAA028D937E5DB6B97E1D456C81BCE119EA8DAF177E7D3FCE230EF298C56C2E06C942D1506E4D45D09846BB525FD3D5673B39660F94AFAEBF3CC70BE2C680ABD1C85A2BD643F44949B9748CC80228B6F4F79AABDB2AB8104882BD70367DD24CDD6D091A1B506",
-        # advert with location
-        "120056CBB26E9DE37E150F9FD087E01D266C21D30088A8C2DBDEFF4E6005726A796FB0D18569EEB69315DDBCFCBEAE402E09AFC9946F3F8BDE8A0477E9AB157865987D78BB1B3F55999C1107830375E5F6C904D5F81FE0A766A260B31BA53EFD03D1E54BFB05925AE739035A6C8F004D757368726F6F6D20F09F8D84202874656D7029",
-        # trace
-        "260334F6E3AA57517E0000000000D026B326D0",
-    ]
-    #for pkt in pkts:
-        #_logger.info("decoded: %s", meshcore.meshcore.MeshcorePacket.deserialize(node, bytes.fromhex(pkt)))
-    esplora_inst.set_frequency(869618000)
-    esplora_inst.set_spreading_factor(8)
-    esplora_inst.set_bandwidth(62500)
-    esplora_inst.set_coding_rate(8)
-    meshcore_inst = meshcore.meshcore.Meshcore(esplora_inst, node)
+    #for pkt in MESHCORE_SAMPLE_PACKETS:
+        #packet = meshcore.meshcore.MeshcorePacket.deserialize(node, bytes.fromhex(pkt))
+        #_logger.info("decoded: %s %s", packet, packet.payload)
+    with esplora_inst.settings():
+        esplora_inst.set_frequency(869618000)
+        esplora_inst.set_spreading_factor(8)
+        esplora_inst.set_bandwidth(62500)
+        esplora_inst.set_coding_rate(8)
+    meshcore_inst = meshcore.meshcore.Meshcore(esplora_inst, node, **kwargs)
     meshcore_inst.start()
+    return meshcore_inst
 
 def lora_sample(esplora_inst):
-    esplora_inst.set_frequency(869618000)
-    esplora_inst.set_spreading_factor(8)
-    esplora_inst.set_bandwidth(125000)
-    esplora_inst.set_coding_rate(8)
-    esplora_inst.set_preamble_length(16)
-    esplora_inst.set_syncword(0x12)
-    esplora_inst.set_aux_lora_settings(
-        crc=True,
-        invert_iq=False,
-        low_data_rate_optimize=False,
-    )
+    with esplora_inst.settings():
+        esplora_inst.set_frequency(869618000)
+        esplora_inst.set_spreading_factor(8)
+        esplora_inst.set_bandwidth(125000)
+        esplora_inst.set_coding_rate(8)
+        esplora_inst.set_preamble_length(16)
+        esplora_inst.set_syncword(0x12)
+        esplora_inst.set_aux_lora_settings(
+            crc=True,
+            invert_iq=False,
+            low_data_rate_optimize=False,
+        )
 
     def rx(p):
         print(f"received {p}")
@@ -59,6 +75,156 @@ def lora_sample(esplora_inst):
         time.sleep(3)
         esplora_inst.tx(lora_modem.LoraPacket("hello world!".encode("UTF-8")))
 
+def virtual_meshcore_stuff(n_nodes=100, duration_secs=60):
+    # random topology, every node hears a handful of neighbours
+    air = virtual_lora.VirtualAir(simulated=True, seed=0, snr_jitter=1.0)
+    rng = random.Random(0)
+    modems = [virtual_lora.VirtualLoraModem(air, f"node{i}") for i in range(n_nodes)]
+    for i, a in enumerate(modems):
+        for b in rng.sample(modems[:i] + modems[i + 1:], min(5, n_nodes - 1)):
+            air.set_link(a, b, rssi=rng.randint(-125, -70), snr=rng.uniform(-12, 10))
+    # repeats are delayed in simulated time too
+    meshcore_insts = [meshcore_stuff(modem, scheduler=air, rng=random.Random(i)) for i, modem in enumerate(modems)]
+    # let random nodes send something every now and then
+    t = 0.0
+    while t < duration_secs:
+        # flood RAW_CUSTOM packets with random content, so every one is new to the mesh
+        rng.choice(modems).tx(lora_modem.LoraPacket(bytes([0x3D, 0]) + rng.randbytes(20)))
+        t += rng.expovariate(1 / 5)
+        air.run_until(t)
+    air.run()
+    _logger.info("virtual air stats: %s", air.stats)
+    repeat_stats = {}
+    for meshcore_inst in meshcore_insts:
+        for k, v in meshcore_inst.repeat_stats.items():
+            repeat_stats[k] = repeat_stats.get(k, 0) + v
+    _logger.info("repeat stats: %s", repeat_stats)
+    for meshcore_inst in meshcore_insts:
+        meshcore_inst.stop()
+
+def meshcore_route_learning_check():
+    """
+    a later copy of a flood advert that took a shorter path has to replace the learned route
+    """
+    node = meshcore.meshcore.MeshcoreNode()
+    routes = meshcore.meshcore.RouteTable()
+    advert = bytes.fromhex(MESHCORE_SAMPLE_PACKETS[1])
+
+    def flood_copy(path):
+        # sample advert is DIRECT without a path, turn it into a flood that went through path
+        return meshcore.meshcore.MeshcorePacket.deserialize(node, bytes([(advert[0] & ~0x3) | meshcore.meshcore.RouteType.FLOOD.value, len(path), *path]) + advert[2:])
+
+    long_copy = flood_copy([0x11, 0x22, 0x33])
+    pubkey = long_copy.payload.pubkey
+    assert routes.learn(long_copy) == [(pubkey, [0x33, 0x22, 0x11])]
+    # same advert again over fewer hops (would be a heard duplicate)
+    assert routes.learn(flood_copy([0x44])) == [(pubkey, [0x44])]
+    assert routes.route_for(pubkey) == (meshcore.meshcore.RouteType.DIRECT, [0x44])
+    # a longer copy doesn't replace the shorter route
+    assert routes.learn(flood_copy([0x55, 0x66])) == []
+    assert routes.get(pubkey) == [0x44]
+    # neither does a longer PATH return from the same node
+    path_return = meshcore.meshcore.MeshcorePacket.deserialize(node, bytes([
+        meshcore.meshcore.PayloadType.PATH.value << 2 | meshcore.meshcore.RouteType.FLOOD.value, 3, 1, 2, 3,
+        0x00, pubkey[0], 0xaa, 0xbb,
+    ]))
+    assert routes.learn(path_return) == []
+    assert routes.get(pubkey) == [0x44]
+    _logger.info("route learning check passed")
+
+def meshcore_decode_bench(n_packets=10000):
+    # decode time and allocations per packet for the sample packets
+    node = meshcore.meshcore.MeshcoreNode()
+    pkts = [bytes.fromhex(pkt) for pkt in MESHCORE_SAMPLE_PACKETS]
+    for pkt in pkts:
+        packet = meshcore.meshcore.MeshcorePacket.deserialize(node, pkt)
+        _logger.info("decoded: %s %s", packet, packet.payload)
+    for pkt in pkts:
+        tstart = time.perf_counter()
+        for _ in range(n_packets):
+            meshcore.meshcore.MeshcorePacket.deserialize(node, pkt).payload
+        tdelta = time.perf_counter() - tstart
+        # peak memory a single decode needs on top of what it returns, a proxy for the copies made
+        tracemalloc.start()
+        peak = 0
+        for _ in range(1000):
+            tracemalloc.reset_peak()
+            current_before = tracemalloc.get_traced_memory()[0]
+            meshcore.meshcore.MeshcorePacket.deserialize(node, pkt).payload
+            peak += tracemalloc.get_traced_memory()[1] - current_before
+        tracemalloc.stop()
+        _logger.info(
+            "header 0x%02x: %fus/packet, %d bytes peak allocation/packet",
+            pkt[0], (tdelta / n_packets) * 1e6, peak / 1000,
+        )
+
+def meshcore_capture_decode(capture_path):
+    # decode throughput over a recorded capture
+    node = meshcore.meshcore.MeshcoreNode()
+    reader = capture.CaptureReader(capture_path)
+    tstart = time.monotonic()
+    for record in reader:
+        meshcore.meshcore.MeshcorePacket.deserialize(node, record.packet.data).payload
+    tdelta = time.monotonic() - tstart
+    _logger.info("decoded %d packets in %fs (%f packets/s)", len(reader), tdelta, len(reader) / tdelta)
+    reader.close()
+
+def esplora_sim_bench(n_packets=10000):
+    # ESPLoraWifi end to end against the firmware stand-in: connect time, RX/TX throughput, reconnect recovery
+    server = esplora_sim.ESPLoraSimServer(simulate_airtime=False)
+    server.start()
+    esplora_inst = esplora.ESPLoraWifi(host="127.0.0.1", port=server.port)
+    with esplora_inst.settings():
+        esplora_inst.set_frequency(869525000)
+        # fastest settings, the TX scheduler paces frames by their airtime
+        esplora_inst.set_spreading_factor(7)
+        esplora_inst.set_bandwidth(500000)
+        esplora_inst.set_coding_rate(5)
+        esplora_inst.set_preamble_length(8)
+        esplora_inst.set_aux_lora_settings(True, False, False)
+    received = []
+
+    def wait_for(fn, timeout=30):
+        tstart = time.monotonic()
+        while not fn():
+            if time.monotonic() - tstart > timeout:
+                raise Exception("timed out")
+            time.sleep(0.001)
+        return time.monotonic() - tstart
+
+    tstart = time.monotonic()
+    esplora_inst.start(received.append)
+    # connected once the modem answered metaQ and we switched to hex
+    wait_for(lambda: esplora_inst._data_encoding == "hex")
+    _logger.info("connect time: %fs", time.monotonic() - tstart)
+
+    payloads = [random.randbytes(random.randint(10, 200)) for _ in range(n_packets)]
+    tstart = time.monotonic()
+    server.inject_iter(payloads)
+    wait_for(lambda: len(received) >= n_packets)
+    tdelta = time.monotonic() - tstart
+    _logger.info("RX: %d packets in %fs (%f packets/s)", n_packets, tdelta, n_packets / tdelta)
+
+    n_tx = n_packets // 10
+    tstart = time.monotonic()
+    futures = [esplora_inst.tx(lora_modem.LoraPacket(p[:16])) for p in payloads[:n_tx]]
+    for f in futures:
+        f.result()
+    tdelta = time.monotonic() - tstart
+    _logger.info("TX: %d packets in %fs (%f packets/s)", n_tx, tdelta, n_tx / tdelta)
+
+    received.clear()
+    tstart = time.monotonic()
+    server.disconnect()
+    # keep offering packets until one makes it through the new connection
+    while not received:
+        server.inject(b"ping")
+        time.sleep(0.001)
+    _logger.info("reconnect recovery time: %fs", time.monotonic() - tstart)
+
+    esplora_inst.stop()
+    server.stop()
+
 if __name__ == "__main__":
     logging.basicConfig(
         format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.DEBUG
@@ -71,6 +237,8 @@ if __name__ == "__main__":
 
     esplora_inst.set_gain(0) # 0 = AGC
     esplora_inst.set_tx_power(20)
+    esplora_inst.set_duty_cycle_budget(0.1) # EU868 869.4-869.65MHz sub-band
+    # esplora_inst.set_capture(capture.CaptureWriter("mesh-python/capture.lcap"))
 
     # meshtastic_stuff(esplora_inst)
     meshcore_stuff(esplora_inst)
@@ -1,15 +1,110 @@
+import asyncio
+import concurrent.futures
+import itertools
 import logging
-import datetime
+import os
 import threading
 import json
-import socket
-from . import lora_modem
 import time
+from . import lora_modem
 import serial
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    def _json_loads(data):
+        return json.loads(data)
+
+    def _json_dumps(data):
+        return json.dumps(data).encode("utf-8")
+
 _logger = logging.getLogger(__name__)
 
+# the firmware always serializes the type first, so we can tell messages apart without parsing them
+_PREFIX_TELEMETRY = b'{"type":"telemetry"'
+_PREFIX_PACKET_RX = b'{"type":"packetRx"'
+_PREFIX_TX_ACK = b'{"type":"txAck"'
+# largest line we are willing to buffer, anything longer is garbage
+_MAX_LINE = 64 * 1024
+# at most one processing error with traceback is logged per interval, the rest is only counted
+_RX_ERROR_LOG_INTERVAL = 10
+
+# all modem links share one asyncio event loop running in its own thread
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="esplora-loop", daemon=True).start()
+        return _loop
+
+
+class _AsyncSerial:
+    """
+    Minimal asyncio adapter for a (POSIX, non-blocking) pyserial port. Only use from the event loop thread.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, port: serial.Serial):
+        self._loop = loop
+        self._port = port
+        self._fd = port.fileno()
+        self._wbuf = bytearray()
+        self.reader = asyncio.StreamReader()
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.reader.set_exception(e)
+            self.close()
+            return
+        if not data:
+            # device went away
+            self.reader.feed_eof()
+            self.close()
+            return
+        self.reader.feed_data(data)
+
+    def _on_writable(self):
+        try:
+            n = os.write(self._fd, self._wbuf)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            _logger.error("serial write failed: %s", e)
+            self._wbuf.clear()
+            n = 0
+        del self._wbuf[:n]
+        if not self._wbuf:
+            self._loop.remove_writer(self._fd)
+
+    def write(self, data: bytes):
+        if not self._wbuf:
+            self._loop.add_writer(self._fd, self._on_writable)
+        self._wbuf += data
+
+    def close(self):
+        if self._port.is_open:
+            self._loop.remove_reader(self._fd)
+            self._loop.remove_writer(self._fd)
+            self._port.close()
+
+
 class ESPLoraBase(lora_modem.LoraModem):
+    # maximum number of packetTx messages waiting for their txAck
+    TX_WINDOW = 4
+    CAD_WAIT_MS = 2000
+    CAD_TIMEOUT_MS = 10000
+
     def __init__(self):
         super().__init__()
         self._settings_data = {
@@ -18,28 +113,167 @@ class ESPLoraBase(lora_modem.LoraModem):
         }
         self._running = False
         self._rx_cb = None
+        self._loop = None
+        self._conn_task = None
+        self._write = None
+        self._meta = None
+        self._rx_errors_suppressed = 0
+        self._rx_error_logged = None
+        self._tx_ids = itertools.count(1)
+        self._tx_inflight = {} # id -> (future, time sent, ack timeout handle)
+        self._tx_inflight_lock = threading.Lock()
+        self._tx_window = threading.Semaphore(self.TX_WINDOW)
+        # encoding of packet data on the link, "list" (JSON list of ints) works with every firmware, "hex" is negotiated via metaQ
+        self._data_encoding = "list"
+
+    def _on_connect(self):
+        """
+        called by subclasses whenever a new link to the modem was established
+        """
+        self._meta = None
+        self._data_encoding = "list"
+        self._tx_data(self._settings_data)
+        self._tx_data({"type": "metaQ"})
+
+    # seconds without any line from the modem after which the link is considered dead, None = wait forever
+    _rx_timeout = None
+
+    async def _open(self):
+        """
+        open the link to the modem, returns (asyncio.StreamReader, write function, close function)
+        the write and close functions will only be called from the event loop thread
+        """
+        raise NotImplementedError()
+
+    async def _conn_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            close = None
+            try:
+                reader, write, close = await self._open()
+                self._write = write
+                self._on_connect()
+                buf = b""
+                while True:
+                    chunk = await asyncio.wait_for(reader.read(_MAX_LINE), self._rx_timeout)
+                    if not chunk:
+                        raise Exception("connection closed")
+                    *lines, buf = (buf + chunk).split(b"\n")
+                    if len(buf) > _MAX_LINE:
+                        self._rx_error(buf[:100], None)
+                        buf = b""
+                    if not lines:
+                        continue
+                    # callbacks may block, keep them off the event loop so other modems aren't affected
+                    await loop.run_in_executor(None, self._rx_lines, lines)
+            except asyncio.CancelledError:
+                self._write = None
+                if close is not None:
+                    close()
+                self._tx_fail_inflight("disconnected")
+                raise
+            except:
+                _logger.exception("exception")
+                self._write = None
+                if close is not None:
+                    close()
+                self._tx_fail_inflight("disconnected")
+                await asyncio.sleep(1) # don't immediately attempt to reconnect
+
+    def _rx_lines(self, lines: list[bytes]):
+        for line in lines:
+            # heartbeat, we don't use it for anything so don't even parse it
+            if line.startswith(_PREFIX_TELEMETRY):
+                continue
+            try:
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith(_PREFIX_PACKET_RX):
+                    self._rx_packet(_json_loads(line))
+                elif line.startswith(_PREFIX_TX_ACK):
+                    data = _json_loads(line)
+                    self._tx_ack(data.get("id"), data.get("success", False), data.get("reason"))
+                elif line.startswith(b"{"):
+                    # rare control messages (meta, settings echo), take the generic path
+                    self._rx_data(json.loads(line))
+                else:
+                    # e.g. "deserializeJson() failed: ..." from the firmware
+                    raise Exception("not a JSON object")
+            except Exception as e:
+                self._rx_error(line, e)
+
+    def _rx_error(self, line: bytes, exc: Exception | None):
+        now = time.monotonic()
+        if self._rx_error_logged is not None and now - self._rx_error_logged < _RX_ERROR_LOG_INTERVAL:
+            self._rx_errors_suppressed += 1
+            return
+        _logger.error(
+            "processing exception for line %r (%d more suppressed since last report)",
+            line,
+            self._rx_errors_suppressed,
+            exc_info=exc,
+        )
+        self._rx_error_logged = now
+        self._rx_errors_suppressed = 0
 
     def _start(self, rx_cb):
         self._running = True
         self._rx_cb = rx_cb
+        self._loop = _get_loop()
+
+        async def _create_task():
+            return asyncio.get_running_loop().create_task(self._conn_loop())
+
+        self._conn_task = asyncio.run_coroutine_threadsafe(_create_task(), self._loop).result()
 
     def _stop(self):
+        async def _cancel_task():
+            self._conn_task.cancel()
+            try:
+                await self._conn_task
+            except asyncio.CancelledError:
+                pass
+
+        asyncio.run_coroutine_threadsafe(_cancel_task(), self._loop).result()
+        self._conn_task = None
         self._running = False
         self._rx_cb = None
 
     def _tx_data(self, data):
-        raise NotImplementedError()
+        # may be called from any thread
+        write = self._write
+        if write is None:
+            _logger.debug("no TX cuz not connected")
+            return
+        self._loop.call_soon_threadsafe(write, _json_dumps(data) + b"\n")
 
     def _rx_data(self, data):
         if not data:
             return
-        if data.get("type") not in ["telemetry"]:
+        if data.get("type") != "telemetry" and _logger.isEnabledFor(logging.DEBUG):
             _logger.debug("rx from modem: %s", data)
-        if data.get("type") != "packetRx":
+        if data.get("type") == "meta":
+            self._meta = data
+            # older firmware doesn't know about dataEncodings, we just keep using lists then
+            if "hex" in data.get("dataEncodings", []):
+                self._tx_data({"type": "settings", "dataEncoding": "hex"})
+            return
+        # settings echo
+        if "type" not in data and "dataEncoding" in data:
+            _logger.debug("modem data encoding: %s", data["dataEncoding"])
+            self._data_encoding = data["dataEncoding"]
             return
+        if data.get("type") == "txAck":
+            self._tx_ack(data.get("id"), data.get("success", False), data.get("reason"))
+            return
+        if data.get("type") == "packetRx":
+            self._rx_packet(data)
+
+    def _rx_packet(self, data):
         try:
             self._rx_cb(lora_modem.LoraPacketReceived(
-                data=bytes(data["data"]),
+                data=self._decode_data(data["data"]),
                 rssi=data["rssi"],
                 snr=data["snr"],
                 freqError=data["freqError"],
@@ -47,16 +281,81 @@ class ESPLoraBase(lora_modem.LoraModem):
         except:
             _logger.exception("rx_cb exception")
 
-    def _tx(self, p: lora_modem.LoraPacket):
+    @staticmethod
+    def _decode_data(data) -> bytes:
+        if isinstance(data, str):
+            return bytes.fromhex(data)
+        return bytes(data)
+
+    def _encode_data(self, data: bytes):
+        if self._data_encoding == "hex":
+            return data.hex()
+        return list(data)
+
+    def _tx(self, p: lora_modem.LoraPacket) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        # wait for a free slot in the in-flight window
+        while not self._tx_window.acquire(timeout=1):
+            if self._tx_thread_stop:
+                future.set_result(lora_modem.TxResult(success=False, reason="stopped"))
+                return future
+        if self._write is None:
+            self._tx_window.release()
+            future.set_result(lora_modem.TxResult(success=False, reason="notConnected"))
+            return future
+        tx_id = next(self._tx_ids)
+        cad_timeout = p.cad_timeout if p.cad_timeout is not None else self.CAD_TIMEOUT_MS
         data = {
             "type": "packetTx",
-            "data": list(p.data),
+            "id": tx_id,
+            "data": self._encode_data(p.data),
             "cad": True,
-            "cadWait": 2000,
-            "cadTimeout": 10000,
+            "cadWait": p.cad_wait if p.cad_wait is not None else self.CAD_WAIT_MS,
+            "cadTimeout": cad_timeout,
         }
+        if p.tx_power is not None and self.supports_per_frame_tx_params():
+            data["txPower"] = p.tx_power
+        # the modem may wait up to cadTimeout for a free channel and then transmits, give it some slack on top
+        ack_timeout = (cad_timeout / 1000) + self._calc_airtime(p) + 5
+        with self._tx_inflight_lock:
+            self._tx_inflight[tx_id] = [future, time.monotonic(), None]
+
+        def _arm_timeout():
+            with self._tx_inflight_lock:
+                if tx_id in self._tx_inflight:
+                    self._tx_inflight[tx_id][2] = self._loop.call_later(ack_timeout, self._tx_ack, tx_id, False, "ackTimeout")
+
+        self._loop.call_soon_threadsafe(_arm_timeout)
         _logger.debug("transmitting: %s", data)
         self._tx_data(data)
+        return future
+
+    def supports_per_frame_tx_params(self) -> bool:
+        # only known once the modem answered metaQ
+        meta = self._meta
+        return meta is not None and meta.get("perFrameTxPower", False)
+
+    def _tx_ack(self, tx_id, success: bool, reason: str | None):
+        with self._tx_inflight_lock:
+            inflight = self._tx_inflight.pop(tx_id, None)
+        if inflight is None:
+            _logger.debug("txAck for unknown id %s", tx_id)
+            return
+        future, t_sent, timeout_handle = inflight
+        if timeout_handle is not None:
+            self._loop.call_soon_threadsafe(timeout_handle.cancel)
+        self._tx_window.release()
+        future.set_result(lora_modem.TxResult(
+            success=success,
+            reason=None if success else reason,
+            latency=time.monotonic() - t_sent,
+        ))
+
+    def _tx_fail_inflight(self, reason: str):
+        with self._tx_inflight_lock:
+            tx_ids = list(self._tx_inflight.keys())
+        for tx_id in tx_ids:
+            self._tx_ack(tx_id, False, reason)
 
     def _set_lora_settings(self, vals: dict):
         for k, v in vals.items():
@@ -91,97 +390,28 @@ class ESPLoraBase(lora_modem.LoraModem):
 
 
 class ESPLoraWifi(ESPLoraBase):
+    _rx_timeout = 15
+
     def __init__(self, host, port):
         super().__init__()
         self._host = host
         self._port = port
-        self._sockfile = None
-        self._rx_thread_stop = None
 
-    def _tx_data(self, data):
-        if self._sockfile is None:
-            _logger.debug("no TX cuz no _sockfile")
-            return
-        self._sockfile.write(json.dumps(data) + "\n")
-        self._sockfile.flush()
+    async def _open(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self._host, self._port), 15)
+        return reader, writer.write, writer.close
 
-    def _start(self, rx_cb):
-        def _conn_thread():
-            while not self._rx_thread_stop.is_set():
-                sock = None
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(15) # 15s timeout
-                    sock.connect((self._host, self._port))
-                    self._sockfile = sock.makefile("rw", encoding="utf-8", newline="\n")
-                    self._tx_data(self._settings_data)
-                    while not self._rx_thread_stop.is_set():
-                        line = self._sockfile.readline()
-                        try:
-                            data = json.loads(line)
-                            self._rx_data(data)
-                        except:
-                            _logger.debug("line causing error: %s", line)
-                            _logger.exception("processing exception")
-                except:
-                    _logger.exception("exception")
-                    self._sockfile = None
-                    if sock is not None:
-                        sock.close()
-                    time.sleep(1) # don't immediately attempt to reconnect
-
-        self._rx_thread_stop = threading.Event()
-        self._rx_thread = threading.Thread(target=_conn_thread)
-        self._rx_thread.start()
-        super()._start(rx_cb)
-
-    def _stop(self):
-        self._rx_thread_stop.set()
-        self._rx_thread.join()
-        super()._stop()
 
 class ESPLoraSerial(ESPLoraBase):
     def __init__(self, port):
         super().__init__()
         self._port = port
-        self._serial_port = None
-        self._rx_thread_stop = None
-
-    def _tx_data(self, data):
-        if self._serial_port is None:
-            _logger.debug("no TX cuz no _serial_port")
-            return
-        self._serial_port.write((json.dumps(data) + "\n").encode("utf-8"))
-        self._serial_port.flush()
 
-    def _start(self, rx_cb):
-        def _conn_thread():
-            while not self._rx_thread_stop.is_set():
-                sock = None
-                try:
-                    self._serial_port = serial.Serial(port=self._port, baudrate=115200, bytesize=8, timeout=10, stopbits=serial.STOPBITS_ONE)
-                    self._tx_data(self._settings_data)
-                    while not self._rx_thread_stop.is_set():
-                        line = self._serial_port.readline()
-                        try:
-                            data = json.loads(line)
-                            self._rx_data(data)
-                        except:
-                            _logger.debug("line causing error: %s", line)
-                            _logger.exception("processing exception")
-                except:
-                    _logger.exception("exception")
-                    self._serial_port = None
-                    if sock is not None:
-                        sock.close()
-                    time.sleep(1) # don't immediately attempt to reconnect
-
-        self._rx_thread_stop = threading.Event()
-        self._rx_thread = threading.Thread(target=_conn_thread)
-        self._rx_thread.start()
-        super()._start(rx_cb)
-
-    def _stop(self):
-        self._rx_thread_stop.set()
-        self._rx_thread.join()
-        super()._stop()
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        port = await loop.run_in_executor(
+            None,
+            lambda: serial.Serial(port=self._port, baudrate=115200, bytesize=8, timeout=0, stopbits=serial.STOPBITS_ONE),
+        )
+        adapter = _AsyncSerial(loop, port)
+        return adapter.reader, adapter.write, adapter.close
@@ -0,0 +1,401 @@
+import collections
+import json
+import logging
+import selectors
+import socket
+import threading
+import time
+from . import capture
+from . import lora_modem
+
+_logger = logging.getLogger(__name__)
+
+TELEMETRY_INTERVAL = 2
+
+# settings the firmware accepts, (JSON key, type)
+_SETTINGS = [
+    ("gain", int),
+    ("txPower", int),
+    ("frequency", int),
+    ("spreadingFactor", int),
+    ("signalBandwidth", int),
+    ("codingRate4", int),
+    ("preambleLength", int),
+    ("syncWord", int),
+    ("CRC", bool),
+    ("invertIQ", bool),
+    ("lowDataRateOptimize", bool),
+]
+
+
+def _dumps(doc: dict) -> bytes:
+    # same compact output as ArduinoJson, esplora relies on '{"type":"...' prefixes
+    return json.dumps(doc, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+class ESPLoraSimServer:
+    """
+    Stand-in for the ESPLora firmware's TCP server, speaking the same newline-JSON protocol as CMDCon.
+    Lets esplora.ESPLoraWifi run end to end on a machine without a radio.
+
+    Like the firmware it serves one client at a time and handles packetTx inline, so nothing else
+    (RX, telemetry) goes out while a frame waits for CAD or is on the air.
+    Received packets are injected with inject()/inject_iter()/inject_capture(), frames sent by the
+    client end up in transmitted (and tx_cb if set). set_channel_busy() makes CAD report a busy channel.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        gain_max: int = 6,
+        tx_power_max: int = 20,
+        simulate_airtime: bool = True,
+        noise_floor: int = -120,
+        rx_queue_len: int = 16,
+        tx_cb=None,
+    ):
+        self._host = host
+        self._port = port
+        self._gain_max = gain_max
+        self._tx_power_max = tx_power_max
+        self._simulate_airtime = simulate_airtime
+        self._noise_floor = noise_floor
+        self._tx_cb = tx_cb
+        self._lock = threading.Lock()
+        # same fixed size queue as the firmware, packets are dropped when the client can't keep up
+        self._rx_queue = collections.deque(maxlen=rx_queue_len)
+        self._settings = {}
+        self._receiving = False
+        self._hex_data = False
+        self._channel_busy_until = 0.0
+        self._sock = None
+        self._client = None
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._thread = None
+        self._thread_stop = False
+        self.transmitted = []
+        self.stats = {
+            "connections": 0,
+            "rx": 0,
+            "rx_dropped": 0,
+            "tx": 0,
+            "tx_failed": 0,
+        }
+
+    @property
+    def port(self) -> int:
+        """
+        the port the server listens on, useful with port=0
+        """
+        return self._sock.getsockname()[1]
+
+    def start(self) -> None:
+        self._sock = socket.create_server((self._host, self._port))
+        self._thread_stop = False
+        self._thread = threading.Thread(target=self._serve, name="esplora-sim")
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._thread_stop = True
+        self._wakeup()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._sock.close()
+
+    def disconnect(self) -> None:
+        """
+        drop the current client, like the modem losing wifi
+        """
+        with self._lock:
+            client = self._client
+        if client is not None:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def set_channel_busy(self, secs: float) -> None:
+        """
+        CAD reports activity for the next secs seconds
+        """
+        self._channel_busy_until = time.monotonic() + secs
+
+    def inject(self, data: bytes, rssi: int = -80, snr: float = 10.0, freq_error: int = 0) -> bool:
+        """
+        receive a packet, returns False if it was dropped (not receiving or queue full)
+        """
+        with self._lock:
+            if not self._receiving or self._client is None or len(self._rx_queue) == self._rx_queue.maxlen:
+                self.stats["rx_dropped"] += 1
+                return False
+            self._rx_queue.append((bytes(data), rssi, snr, freq_error))
+        self._wakeup()
+        return True
+
+    def inject_iter(self, packets, interval: float | None = None, should_run_fn=lambda: True) -> int:
+        """
+        Inject everything from an iterable of bytes or LoraPacketReceived. With interval=None packets are only
+        throttled by the RX queue (like a busy channel saturating the modem). Returns how many were accepted.
+        """
+        accepted = 0
+        for p in packets:
+            if not should_run_fn():
+                break
+            if isinstance(p, lora_modem.LoraPacketReceived):
+                args = (p.data, p.rssi, p.snr, p.freqError)
+            else:
+                args = (p,)
+            if interval is None:
+                # wait for room in the queue instead of dropping
+                while self._receiving and self._client is not None and len(self._rx_queue) == self._rx_queue.maxlen:
+                    time.sleep(0.001)
+            else:
+                time.sleep(interval)
+            if self.inject(*args):
+                accepted += 1
+        return accepted
+
+    def inject_capture(self, path: str, speed: float | None = 1.0, should_run_fn=lambda: True) -> None:
+        """
+        inject the packets of a capture file (see capture.CaptureWriter), speed as in CaptureReader.replay
+        """
+        reader = capture.CaptureReader(path)
+        try:
+            reader.replay(lambda p: self.inject(p.data, p.rssi, p.snr, p.freqError), speed, should_run_fn)
+        finally:
+            reader.close()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def _serve(self):
+        sel = selectors.DefaultSelector()
+        sel.register(self._sock, selectors.EVENT_READ)
+        sel.register(self._wakeup_r, selectors.EVENT_READ)
+        try:
+            while not self._thread_stop:
+                for key, _ in sel.select():
+                    if key.fileobj is self._wakeup_r:
+                        self._drain_wakeup()
+                    elif key.fileobj is self._sock:
+                        client, addr = self._sock.accept()
+                        _logger.info("new TCP client connected from %s", addr)
+                        try:
+                            self._serve_client(client)
+                        except OSError:
+                            _logger.debug("client connection error", exc_info=True)
+                        finally:
+                            client.close()
+                        _logger.info("TCP client disconnected")
+        finally:
+            sel.close()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _serve_client(self, client: socket.socket):
+        with self._lock:
+            self._client = client
+            self._rx_queue.clear()
+            # new connection, the client has to negotiate everything again (see CMDCon::set_stream)
+            self._hex_data = False
+            self._receiving = False
+            self.stats["connections"] += 1
+        sel = selectors.DefaultSelector()
+        sel.register(client, selectors.EVENT_READ)
+        sel.register(self._wakeup_r, selectors.EVENT_READ)
+        buf = b""
+        t_telem = time.monotonic()
+        try:
+            while not self._thread_stop:
+                now = time.monotonic()
+                if now - t_telem >= TELEMETRY_INTERVAL:
+                    self._send_telemetry(client)
+                    t_telem = now
+                self._dump_packets(client)
+                for key, _ in sel.select(max(0, t_telem + TELEMETRY_INTERVAL - time.monotonic())):
+                    if key.fileobj is self._wakeup_r:
+                        self._drain_wakeup()
+                        continue
+                    chunk = client.recv(65536)
+                    if not chunk:
+                        return
+                    *lines, buf = (buf + chunk).split(b"\n")
+                    for line in lines:
+                        self._process_line(client, line.strip())
+        finally:
+            sel.close()
+            with self._lock:
+                self._client = None
+                self._receiving = False
+
+    def _send_telemetry(self, client: socket.socket):
+        doc = {"type": "telemetry"}
+        if self._receiving:
+            doc["rssi"] = -60 if time.monotonic() < self._channel_busy_until else self._noise_floor
+        client.sendall(_dumps(doc))
+
+    def _dump_packets(self, client: socket.socket):
+        while True:
+            with self._lock:
+                if not self._rx_queue:
+                    return
+                data, rssi, snr, freq_error = self._rx_queue.popleft()
+                hex_data = self._hex_data
+            doc = {
+                "type": "packetRx",
+                "rssi": rssi,
+                "snr": snr,
+                "freqError": freq_error,
+                "data": data.hex() if hex_data else list(data),
+            }
+            client.sendall(_dumps(doc))
+            self.stats["rx"] += 1
+
+    def _process_line(self, client: socket.socket, line: bytes):
+        if not line:
+            return
+        try:
+            doc = json.loads(line)
+            if not isinstance(doc, dict):
+                raise ValueError("not an object")
+        except ValueError:
+            client.sendall(b"deserializeJson() failed: InvalidInput\n")
+            return
+        match doc.get("type"):
+            case "settings":
+                client.sendall(_dumps(self._apply_settings(doc)))
+            case "metaQ":
+                client.sendall(_dumps({
+                    "type": "meta",
+                    "gainMax": self._gain_max,
+                    "txPowerMax": self._tx_power_max,
+                    "dataEncodings": ["list", "hex"],
+                    "perFrameTxPower": True,
+                }))
+            case "packetTx":
+                ack = self._packet_tx(doc)
+                if ack is not None:
+                    client.sendall(_dumps(ack))
+
+    def _apply_settings(self, doc: dict) -> dict:
+        out = {}
+        for key, typ in _SETTINGS:
+            value = doc.get(key)
+            # bool is an int subclass, don't let it pass as a number
+            if not isinstance(value, typ) or (typ is int and isinstance(value, bool)):
+                continue
+            if key == "gain" and not 0 <= value <= self._gain_max:
+                continue
+            if key == "txPower" and not 0 <= value <= self._tx_power_max:
+                continue
+            if key == "spreadingFactor" and not 6 <= value <= 12:
+                continue
+            if key == "codingRate4" and not 5 <= value <= 8:
+                continue
+            self._settings[key] = value
+            out[key] = value
+        if isinstance(doc.get("receive"), bool):
+            with self._lock:
+                self._receiving = doc["receive"]
+            if doc["receive"]:
+                out["receive"] = True
+        if doc.get("dataEncoding") in ("list", "hex"):
+            with self._lock:
+                self._hex_data = doc["dataEncoding"] == "hex"
+            out["dataEncoding"] = doc["dataEncoding"]
+        return out
+
+    def _airtime(self, size: int) -> float:
+        s = self._settings
+        try:
+            return float(lora_modem.airtime_table(
+                s["spreadingFactor"],
+                s["signalBandwidth"],
+                s["codingRate4"],
+                s["preambleLength"],
+                s.get("CRC", True),
+                s.get("lowDataRateOptimize", False),
+            )[size])
+        except KeyError:
+            # not configured enough to tell
+            return 0.0
+
+    def _packet_tx(self, doc: dict) -> dict | None:
+        data = doc.get("data")
+        try:
+            if isinstance(data, str):
+                data = bytes.fromhex(data)
+            elif isinstance(data, list):
+                data = bytes(data)
+            else:
+                return None
+        except ValueError:
+            # the firmware silently ignores malformed data
+            return None
+        if not data or len(data) > lora_modem.MAX_PAYLOAD_BYTES:
+            return None
+
+        reason = None
+        tx_power = doc.get("txPower", self._settings.get("txPower"))
+        if "txPower" in doc and "txPower" not in self._settings:
+            # like the firmware, there would be nothing to restore after the frame
+            reason = "txPowerNoDefault"
+        elif isinstance(tx_power, int) and not 0 <= tx_power <= self._tx_power_max:
+            reason = "setTxPower failed"
+        if reason is None and doc.get("cad") is True:
+            cad_wait = doc.get("cadWait", 1) / 1000
+            cad_timeout = doc.get("cadTimeout", 1) / 1000
+            tstart = time.monotonic()
+            while time.monotonic() < self._channel_busy_until:
+                if time.monotonic() - tstart >= cad_timeout:
+                    reason = "cadTimeout"
+                    break
+                time.sleep(cad_wait)
+
+        if reason is None:
+            if self._simulate_airtime:
+                time.sleep(self._airtime(len(data)))
+            self.transmitted.append((data, tx_power))
+            self.stats["tx"] += 1
+            if self._tx_cb is not None:
+                try:
+                    self._tx_cb(data, tx_power)
+                except:
+                    _logger.exception("tx_cb exception")
+        else:
+            self.stats["tx_failed"] += 1
+
+        ack = {
+            "type": "txAck",
+            "id": doc.get("id"),
+            "success": reason is None,
+        }
+        if reason is not None:
+            ack["reason"] = reason
+        return ack
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.DEBUG
+    )
+
+    server = ESPLoraSimServer(host="0.0.0.0", port=8000)
+    server.start()
+    try:
+        while True:
+            time.sleep(1)
+    finally:
+        server.stop()
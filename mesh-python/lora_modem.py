@@ -1,87 +1,221 @@
+import array
+import concurrent.futures
+import contextlib
 import dataclasses
+import enum
+import functools
+import heapq
 import math
 import logging
-import datetime
-import math
+import threading
+import time
+import numpy
 
 
 _logger = logging.getLogger(__name__)
 
 
 def calculate_airtime(
+    spreading_factor: int | numpy.ndarray,
+    bandwidth: int | numpy.ndarray,
+    coding_rate_4: int | numpy.ndarray,
+    preamble_len: int | numpy.ndarray,
+    crc: bool | numpy.ndarray,
+    ldro: bool | numpy.ndarray,
+    with_header: bool | numpy.ndarray,
+    payload_bytes: int | numpy.ndarray,
+):
+    """
+    Airtime in seconds. Every argument may also be an array (or anything numpy can broadcast),
+    in which case an array of airtimes is returned.
+    """
+    # calculations from:
+    # https://www.mobilefish.com/download/lora/lora_part17.pdf
+    # https://www.rfwireless-world.com/calculators/lorawan-airtime-calculator
+    # https://www.semtech.com/design-support/lora-calculator
+    spreading_factor = numpy.asarray(spreading_factor)
+    crc = numpy.asarray(crc, dtype=bool)
+    ldro = numpy.asarray(ldro, dtype=bool)
+    with_header = numpy.asarray(with_header, dtype=bool)
+
+    t_sym = numpy.exp2(spreading_factor) / bandwidth
+    t_preamble = (numpy.asarray(preamble_len) + 4.25) * t_sym
+
+    payload_data_bits = 8 * numpy.asarray(payload_bytes)
+    crc_bits = numpy.where(crc, 16, 0)
+    header_bits = numpy.where(with_header, 0, 20)
+    bits_per_block = 4 * (spreading_factor - numpy.where(ldro, 2, 0))
+    payload_blocks = numpy.ceil((payload_data_bits - (4 * spreading_factor) + 28 + crc_bits - header_bits) / bits_per_block)
+    payload_syms = 8 + numpy.maximum(payload_blocks * coding_rate_4, 0)
+
+    t_payload = payload_syms * t_sym
+    airtime = t_preamble + t_payload
+    if airtime.ndim == 0:
+        return float(airtime)
+    return airtime
+
+
+MAX_PAYLOAD_BYTES = 255
+
+
+@functools.lru_cache(maxsize=32)
+def airtime_table(
     spreading_factor: int,
     bandwidth: int,
     coding_rate_4: int,
     preamble_len: int,
     crc: bool,
     ldro: bool,
-    with_header: bool,
-    payload_bytes: int,
-):
-    # calculations from:
-    # https://www.mobilefish.com/download/lora/lora_part17.pdf
-    # https://www.rfwireless-world.com/calculators/lorawan-airtime-calculator
-    # https://www.semtech.com/design-support/lora-calculator
-    t_sym = ((2 ** spreading_factor) / bandwidth)
-    t_preamble = (preamble_len + 4.25) * t_sym
-    payload_data_syms = 8 * payload_bytes
-    # this shit crazy lmao, I should make it more readable sometime...
-    payload_syms = (
-        8
-        + max(
-            math.ceil(
-                (payload_data_syms - (4 * spreading_factor) + 28 + (16 if crc else 0) - (0 if with_header else 20))
-                / (4 * (spreading_factor - (2 if ldro else 0)))
-            ) * (coding_rate_4),
-            0,
-        )
+    with_header: bool = True,
+) -> numpy.ndarray:
+    """
+    Read-only table of airtimes indexed by payload size (0-MAX_PAYLOAD_BYTES bytes) for one modem configuration
+    """
+    table = calculate_airtime(
+        spreading_factor,
+        bandwidth,
+        coding_rate_4,
+        preamble_len,
+        crc,
+        ldro,
+        with_header,
+        numpy.arange(MAX_PAYLOAD_BYTES + 1),
     )
-    t_payload = (payload_syms) * t_sym
-    return t_preamble + t_payload
+    table.flags.writeable = False
+    return table
 
 
 class DutyCycleTracker:
-    def __init__(self, observed_max_secs, interval_secs):
+    """
+    Tracks on time in fixed-size buckets of interval_secs over the last observed_max_secs.
+
+    Internally this is a ring buffer of prefix sums: for every bucket in the observation window we
+    store the total on time reported before that bucket started. The on time within any window is
+    then the running total minus the prefix sum at the start of the window, so both report and
+    get_duty are constant time regardless of the window size.
+    """
+
+    def __init__(self, observed_max_secs, interval_secs, windows=(60, 60*10, 60*60), clock=time.monotonic):
+        self._clock = clock
         self._interval = interval_secs
         self._n_buckets = math.ceil(observed_max_secs / self._interval)
-        self._buckets = [0.0] * self._n_buckets
-        self._t_last = datetime.datetime.now().timestamp()
+        # _prefix[b % n] = total on time reported before bucket b started
+        self._prefix = array.array("d", [0.0] * self._n_buckets)
+        self._total = 0.0
+        self._bucket = 0
+        self._t_last = self._clock()
+        self._lock = threading.Lock()
+        self._windows = tuple(windows)
+        for w in self._windows:
+            self._check_window(w)
+
+    def _check_window(self, secs):
+        if secs < self._interval:
+            raise Exception("asked for duty cycle in timeframe smaller than interval")
+        if math.ceil(secs / self._interval) > self._n_buckets:
+            raise Exception("asked for time period larger than the maximum observal time")
+
+    def _advance(self):
+        tnow = self._clock()
+        n_new = int((tnow - self._t_last) / self._interval)
+        if n_new <= 0:
+            return
+        self._t_last += n_new * self._interval
+        # every bucket older than the observation window is forgotten anyway, so we never
+        # have to touch more than _n_buckets entries
+        for _ in range(min(n_new, self._n_buckets)):
+            self._bucket += 1
+            self._prefix[self._bucket % self._n_buckets] = self._total
+        if n_new > self._n_buckets:
+            self._bucket += n_new - self._n_buckets
+
+    def _sum(self, n_buckets):
+        # sum of the newest n_buckets buckets (including the current one)
+        return self._total - self._prefix[(self._bucket - n_buckets + 1) % self._n_buckets]
 
     def report(self, secs):
         if secs > self._interval:
             raise Exception("on time > interval time")
 
-        tnow = datetime.datetime.now().timestamp()
-        tdelta = tnow - self._t_last
-        # when called at intervals smaller than self._interval, try to be accurate
-        self._t_last = tnow - (tdelta % self._interval)
-
-        # add buckets depending on the time elapsed
-        self._buckets = ([0.0] * int(tdelta / self._interval)) + self._buckets
-
-        # remove buckets outside the maximum observation time
-        if len(self._buckets) - self._n_buckets > 0:
-            del self._buckets[-(len(self._buckets) - self._n_buckets):]
-
-        # actually add the on time to the current bucket
-        self._buckets[0] += secs
+        with self._lock:
+            self._advance()
+            self._total += secs
 
     def get_duty(self, secs=None):
         if secs is None:
             secs = self._n_buckets * self._interval
-        if secs < self._interval:
-            raise Exception("asked for duty cycle in timeframe smaller than interval")
-        n_buckets_sum = math.ceil(secs / self._interval)
-        if n_buckets_sum > len(self._buckets):
-            raise Exception("asked for time period larger than the maximum observal time")
-        return sum(self._buckets[:n_buckets_sum]) / secs
+        self._check_window(secs)
+        with self._lock:
+            self._advance()
+            return self._sum(math.ceil(secs / self._interval)) / secs
+
+    def get_wait(self, secs, max_on_secs) -> float:
+        """
+        seconds until the on time within the last secs seconds has dropped to max_on_secs or below
+        """
+        self._check_window(secs)
+        with self._lock:
+            self._advance()
+            n_buckets = math.ceil(secs / self._interval)
+            on_time = self._sum(n_buckets)
+            t_next_bucket = self._t_last + self._interval - self._clock()
+            # drop the oldest buckets one by one until we are below the limit
+            oldest = self._bucket - n_buckets + 1
+            for i in range(n_buckets):
+                if on_time <= max_on_secs:
+                    return max(t_next_bucket, 0.0) + (i - 1) * self._interval if i > 0 else 0.0
+                bucket_end = self._total if oldest + i == self._bucket else self._prefix[(oldest + i + 1) % self._n_buckets]
+                on_time -= bucket_end - self._prefix[(oldest + i) % self._n_buckets]
+            return max(t_next_bucket, 0.0) + (n_buckets - 1) * self._interval
+
+    def get_duties(self) -> dict[int, float]:
+        """
+        duty cycle for every window configured in the constructor, {window_secs: duty}
+        """
+        with self._lock:
+            self._advance()
+            return {w: self._sum(math.ceil(w / self._interval)) / w for w in self._windows}
+
+
+class TxPriority(enum.IntEnum):
+    """
+    lower values are transmitted first
+    """
+    ACK = 0
+    OWN = 1
+    REPEAT = 2
+
+
+class TxBudgetPolicy(enum.Enum):
+    DEFER = "defer" # wait until the duty cycle budget allows transmitting
+    DROP = "drop" # drop frames that would exceed the duty cycle budget
 
 
 @dataclasses.dataclass
+class TxResult:
+    success: bool
+    reason: str | None = None # why TX failed, e.g. "cadTimeout" when the channel never became free
+    latency: float | None = None # seconds from handing the packet to the modem until it confirmed TX, if the modem reports that
+
+
+@dataclasses.dataclass(order=True)
+class _TxQueueEntry:
+    priority: TxPriority
+    seq: int
+    airtime: float = dataclasses.field(compare=False)
+    packet: "LoraPacket" = dataclasses.field(compare=False)
+    future: concurrent.futures.Future = dataclasses.field(compare=False)
+
+
+@dataclasses.dataclass(slots=True)
 class LoraPacket:
     data: bytes
+    # per-frame radio overrides for TX, None = modem default
+    tx_power: int | None = dataclasses.field(default=None, kw_only=True) # TX power (dBm)
+    cad_wait: int | None = dataclasses.field(default=None, kw_only=True) # time to wait between CAD attempts (ms)
+    cad_timeout: int | None = dataclasses.field(default=None, kw_only=True) # give up on TX when the channel is busy this long (ms)
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class LoraPacketReceived(LoraPacket):
     snr: float # SNR (dB)
     rssi: int # RSSI (dBm)
@@ -89,104 +223,351 @@ class LoraPacketReceived(LoraPacket):
 
 class LoraModem:
     def __init__(self):
+        self._frequency = None
         self._spreading_factor = None
         self._bandwidth = None
         self._coding_rate = None
         self._preamble_length = None
         self._crc = None
         self._low_data_rate_optimize = None
+        self._airtime_table = None
         self._dt_rx = DutyCycleTracker(60*60, 60)
         self._dt_tx = DutyCycleTracker(60*60, 60)
+        self._tx_budget = None
+        self._tx_budget_window = 60*60
+        self._tx_budget_policy = TxBudgetPolicy.DEFER
+        self._tx_queue = []
+        self._tx_queue_seq = 0
+        self._tx_queue_airtime = 0.0
+        self._tx_cond = threading.Condition()
+        self._tx_thread = None
+        self._tx_thread_stop = False
+        self._capture = None
+        self._lora_params = {} # last applied params
+        self._settings_batch = None
+        self._settings_lock = threading.RLock()
+
+    def _get_airtime_table(self) -> numpy.ndarray:
+        if self._airtime_table is None:
+            for a in ["_spreading_factor", "_bandwidth", "_coding_rate", "_preamble_length", "_crc", "_low_data_rate_optimize"]:
+                if getattr(self, a) is None:
+                    raise Exception(f"attr '{a}' required for _calc_airtime")
+            self._airtime_table = airtime_table(
+                self._spreading_factor,
+                self._bandwidth,
+                self._coding_rate,
+                self._preamble_length,
+                self._crc,
+                self._low_data_rate_optimize,
+            )
+        return self._airtime_table
 
     def _calc_airtime(self, packet: LoraPacket):
-        for a in ["_spreading_factor", "_bandwidth", "_coding_rate", "_preamble_length", "_crc", "_low_data_rate_optimize"]:
-            if getattr(self, a) is None:
-                raise Exception(f"attr '{a}' required for _calc_airtime")
-        return calculate_airtime(
-            self._spreading_factor,
-            self._bandwidth,
-            self._coding_rate,
-            self._preamble_length,
-            self._crc,
-            self._low_data_rate_optimize,
-            True,
-            len(packet.data),
-        )
+        return float(self._get_airtime_table()[len(packet.data)])
+
+    def calc_airtime_bulk(self, payload_sizes) -> numpy.ndarray:
+        """
+        airtimes for an array of payload sizes with the current modem configuration
+        """
+        return self._get_airtime_table()[numpy.asarray(payload_sizes)]
+
+    def _set_airtime_param(self, attr: str, value) -> None:
+        if getattr(self, attr) != value:
+            setattr(self, attr, value)
+            self._airtime_table = None
+
+    @staticmethod
+    def _format_duties(tracker: DutyCycleTracker) -> str:
+        return " ".join(f"{int(w / 60)}min: {d * 100:f}%" for w, d in tracker.get_duties().items())
 
     def start(self, rx_cb):
         def wrapped_rx_cb(p):
             airtime = self._calc_airtime(p)
             self._dt_rx.report(airtime)
             _logger.debug("RX airtime: %fs", airtime)
-            _logger.debug(
-                "RX duty cycle: 1min: %f%% 10min: %f%% 60min: %f%%",
-                self._dt_rx.get_duty(60) * 100,
-                self._dt_rx.get_duty(60*10) * 100,
-                self._dt_rx.get_duty(60*60) * 100,
-            )
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug("RX duty cycle: %s", self._format_duties(self._dt_rx))
+            if self._capture is not None:
+                try:
+                    self._capture.write(p, self.get_lora_params())
+                except:
+                    _logger.exception("capture write exception")
             rx_cb(p)
         self._start(wrapped_rx_cb)
+        with self._tx_cond:
+            self._tx_thread_stop = False
+        self._tx_thread = threading.Thread(target=self._tx_scheduler_thread)
+        self._tx_thread.start()
 
     def _start(self, rx_cb):
         raise NotImplementedError()
 
     def stop(self):
+        with self._tx_cond:
+            self._tx_thread_stop = True
+            self._tx_cond.notify_all()
+        if self._tx_thread is not None:
+            self._tx_thread.join()
+            self._tx_thread = None
         self._stop()
 
     def _stop(self):
         raise NotImplementedError()
 
-    def tx(self, p: LoraPacket):
+    def set_capture(self, writer) -> None:
+        """
+        record every received packet into a capture.CaptureWriter, None stops recording
+        """
+        self._capture = writer
+
+    def get_lora_params(self) -> dict:
+        return {
+            "frequency": self._frequency,
+            "bandwidth": self._bandwidth,
+            "spreading_factor": self._spreading_factor,
+            "coding_rate": self._coding_rate,
+            "preamble_length": self._preamble_length,
+            "crc": self._crc,
+            "low_data_rate_optimize": self._low_data_rate_optimize,
+        }
+
+    def set_duty_cycle_budget(self, duty: float | None, window_secs: int = 60*60, policy: TxBudgetPolicy = TxBudgetPolicy.DEFER) -> None:
+        """
+        Limit the TX duty cycle (0-1, e.g. 0.01 for 1%) within window_secs. None disables the limit.
+        Frames that would exceed the budget are either deferred or dropped depending on policy.
+        """
+        self._dt_tx._check_window(window_secs)
+        with self._tx_cond:
+            self._tx_budget = duty
+            self._tx_budget_window = window_secs
+            self._tx_budget_policy = policy
+            if duty is not None:
+                # frames queued under the old budget may not fit anymore, the scheduler would defer them forever
+                kept = []
+                for entry in self._tx_queue:
+                    if entry.airtime <= duty * window_secs:
+                        kept.append(entry)
+                        continue
+                    _logger.warning("dropping queued TX packet, airtime %fs can never fit into the new duty cycle budget", entry.airtime)
+                    if entry.future.set_running_or_notify_cancel():
+                        entry.future.set_result(TxResult(success=False, reason="dutyCycleBudget"))
+                if len(kept) != len(self._tx_queue):
+                    heapq.heapify(kept)
+                    self._tx_queue = kept
+                    self._tx_queue_airtime = sum(entry.airtime for entry in kept)
+            self._tx_cond.notify_all()
+
+    def _tx_budget_wait(self, airtime: float) -> float:
+        """
+        seconds until a frame with the given airtime fits into the duty cycle budget
+        """
+        if self._tx_budget is None:
+            return 0.0
+        return self._dt_tx.get_wait(self._tx_budget_window, (self._tx_budget * self._tx_budget_window) - airtime)
+
+    def tx_queue_depth(self) -> int:
+        with self._tx_cond:
+            return len(self._tx_queue)
+
+    def tx_expected_wait(self) -> float:
+        """
+        estimated seconds until everything currently queued has been transmitted
+        """
+        with self._tx_cond:
+            queued_airtime = self._tx_queue_airtime
+        return self._tx_budget_wait(queued_airtime) + queued_airtime
+
+    def tx(self, p: LoraPacket, priority: TxPriority = TxPriority.OWN) -> concurrent.futures.Future:
+        """
+        Queue a packet for transmission, the TX scheduler thread sends it when the duty cycle budget allows.
+        The returned future resolves to a TxResult once the modem is done with the packet.
+        Cancelling the future before the frame left the queue drops it.
+        """
+        future = concurrent.futures.Future()
         airtime = self._calc_airtime(p)
-        self._dt_tx.report(airtime)
-        _logger.debug("TX airtime: %fs", airtime)
-        _logger.debug(
-            "TX duty cycle: 1min: %f%% 10min: %f%% 60min: %f%%",
-            self._dt_tx.get_duty(60) * 100,
-            self._dt_tx.get_duty(60*10) * 100,
-            self._dt_tx.get_duty(60*60) * 100,
-        )
-        self._tx(p)
-
-    def _tx(self, p: LoraPacket):
+        with self._tx_cond:
+            if self._tx_budget is not None and airtime > self._tx_budget * self._tx_budget_window:
+                _logger.warning("dropping TX packet, airtime %fs can never fit into the duty cycle budget", airtime)
+                future.set_result(TxResult(success=False, reason="dutyCycleBudget"))
+                return future
+            heapq.heappush(self._tx_queue, _TxQueueEntry(priority, self._tx_queue_seq, airtime, p, future))
+            self._tx_queue_seq += 1
+            self._tx_queue_airtime += airtime
+            self._tx_cond.notify_all()
+        return future
+
+    @staticmethod
+    def _tx_backend_done(future: concurrent.futures.Future, backend_future: concurrent.futures.Future):
+        if backend_future.cancelled():
+            # future is already running, it can't be cancelled the normal way
+            future.set_exception(concurrent.futures.CancelledError())
+        elif backend_future.exception() is not None:
+            future.set_exception(backend_future.exception())
+        else:
+            future.set_result(backend_future.result())
+
+    def _tx_queue_pop(self) -> _TxQueueEntry:
+        # needs _tx_cond held
+        entry = heapq.heappop(self._tx_queue)
+        if self._tx_queue:
+            self._tx_queue_airtime -= entry.airtime
+        else:
+            # don't let float rounding leave a tiny wait behind on an empty queue
+            self._tx_queue_airtime = 0.0
+        return entry
+
+    def _tx_scheduler_thread(self):
+        while True:
+            with self._tx_cond:
+                while not self._tx_thread_stop and not self._tx_queue:
+                    self._tx_cond.wait()
+                if self._tx_thread_stop:
+                    for queued in self._tx_queue:
+                        queued.future.cancel()
+                    self._tx_queue = []
+                    self._tx_queue_airtime = 0.0
+                    return
+                entry = self._tx_queue[0]
+                if entry.future.cancelled():
+                    # the caller changed its mind while the frame was queued
+                    self._tx_queue_pop()
+                    continue
+                wait = self._tx_budget_wait(entry.airtime)
+                if wait > 0 and self._tx_budget_policy == TxBudgetPolicy.DROP:
+                    _logger.warning("dropping TX packet, duty cycle budget exceeded (would have to wait %fs)", wait)
+                    self._tx_queue_pop()
+                    if entry.future.set_running_or_notify_cancel():
+                        entry.future.set_result(TxResult(success=False, reason="dutyCycleBudget"))
+                    continue
+                if wait > 0:
+                    _logger.debug("TX deferred by %fs for duty cycle budget", wait)
+                    # re-evaluate after waiting, something with a higher priority may have been queued meanwhile
+                    self._tx_cond.wait(wait)
+                    continue
+                self._tx_queue_pop()
+                # from here on the frame can't be cancelled anymore
+                if not entry.future.set_running_or_notify_cancel():
+                    continue
+
+            if entry.packet.tx_power is not None and not self.supports_per_frame_tx_params() and self._lora_params.get("tx_power") is None:
+                # emulating it needs something to go back to afterwards, otherwise the override would stick for every later frame
+                _logger.warning("refusing TX packet with per-frame TX power, no default TX power set")
+                entry.future.set_result(TxResult(success=False, reason="txPowerNoDefault"))
+                continue
+
+            self._dt_tx.report(entry.airtime)
+            _logger.debug("TX airtime: %fs", entry.airtime)
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug("TX duty cycle: %s", self._format_duties(self._dt_tx))
+            # emulate per-frame TX power on modems that can't do it, safe since this thread does every TX
+            restore_tx_power = None
+            if entry.packet.tx_power is not None and not self.supports_per_frame_tx_params():
+                restore_tx_power = self._lora_params.get("tx_power")
+                self.set_tx_power(entry.packet.tx_power)
+            try:
+                backend_future = self._tx(entry.packet)
+            except Exception as e:
+                _logger.exception("TX exception")
+                entry.future.set_exception(e)
+            else:
+                if backend_future is None:
+                    entry.future.set_result(TxResult(success=True))
+                else:
+                    backend_future.add_done_callback(functools.partial(self._tx_backend_done, entry.future))
+            if restore_tx_power is not None:
+                self.set_tx_power(restore_tx_power)
+
+            # the modem is busy for at least the airtime, pace the queue accordingly so bursts get smoothed out
+            with self._tx_cond:
+                self._tx_cond.wait_for(lambda: self._tx_thread_stop, timeout=entry.airtime)
+
+    def supports_per_frame_tx_params(self) -> bool:
+        """
+        Whether the modem applies LoraPacket.tx_power for just that frame. If not the TX scheduler
+        changes the modem TX power around the frame instead, which costs extra settings updates.
+        CAD parameters are ignored by modems that don't support them.
+        """
+        return False
+
+    def _tx(self, p: LoraPacket) -> concurrent.futures.Future | None:
+        """
+        Send a packet. Modems that report TX completion return a future resolving to a TxResult,
+        for everything else returning None means the packet counts as sent.
+        """
         raise NotImplementedError()
 
     def _set_lora_params(self, params):
+        """
+        apply changed settings, only gets called with the params that actually differ from what was applied before
+        """
         raise NotImplementedError()
 
+    def _update_lora_params(self, params):
+        with self._settings_lock:
+            if self._settings_batch is not None:
+                self._settings_batch.update(params)
+                return
+            self._apply_lora_params(params)
+
+    def _apply_lora_params(self, params):
+        changed = {k: v for k, v in params.items() if k not in self._lora_params or self._lora_params[k] != v}
+        if not changed:
+            return
+        self._lora_params.update(changed)
+        self._set_lora_params(changed)
+
+    @contextlib.contextmanager
+    def settings(self):
+        """
+        Batch settings changes, everything set within the block is applied as one update when it exits.
+        Other threads changing settings wait until the batch is done.
+        """
+        with self._settings_lock:
+            outermost = self._settings_batch is None
+            if outermost:
+                self._settings_batch = {}
+            try:
+                yield self
+            finally:
+                if outermost:
+                    batch = self._settings_batch
+                    self._settings_batch = None
+                    self._apply_lora_params(batch)
+
     def set_gain(self, gain: int):
         """
         0 = AGC, 1=min 10=max
         """
-        self._set_lora_params({"gain": gain})
+        self._update_lora_params({"gain": gain})
 
     def set_frequency(self, freq_hz: int) -> None:
-        self._set_lora_params({"frequency": freq_hz})
+        self._frequency = freq_hz
+        self._update_lora_params({"frequency": freq_hz})
 
     def set_spreading_factor(self, sf: int) -> None:
-        self._spreading_factor = sf
-        self._set_lora_params({"spreading_factor": sf})
+        self._set_airtime_param("_spreading_factor", sf)
+        self._update_lora_params({"spreading_factor": sf})
 
     def set_bandwidth(self, bandwidth: int) -> None:
-        self._bandwidth = bandwidth
-        self._set_lora_params({"bandwidth": bandwidth})
+        self._set_airtime_param("_bandwidth", bandwidth)
+        self._update_lora_params({"bandwidth": bandwidth})
 
     def set_coding_rate(self, coding_rate: int) -> None:
         """
         Coding rate 4/x
         """
-        self._coding_rate = coding_rate
-        self._set_lora_params({"coding_rate": coding_rate})
+        self._set_airtime_param("_coding_rate", coding_rate)
+        self._update_lora_params({"coding_rate": coding_rate})
 
     def set_preamble_length(self, bits: int) -> None:
-        self._preamble_length = bits
-        self._set_lora_params({"preamble_length": bits})
+        self._set_airtime_param("_preamble_length", bits)
+        self._update_lora_params({"preamble_length": bits})
 
     def set_syncword(self, syncword: int) -> None:
-        self._set_lora_params({"syncword": syncword})
+        self._update_lora_params({"syncword": syncword})
 
     def set_tx_power(self, tx_power: int) -> None:
-        self._set_lora_params({"tx_power": tx_power})
+        self._update_lora_params({"tx_power": tx_power})
 
     def set_aux_lora_settings(
         self,
@@ -194,9 +575,9 @@ class LoraModem:
         invert_iq: bool,
         low_data_rate_optimize: bool,
     ):
-        self._crc = crc
-        self._low_data_rate_optimize = low_data_rate_optimize
-        self._set_lora_params({
+        self._set_airtime_param("_crc", crc)
+        self._set_airtime_param("_low_data_rate_optimize", low_data_rate_optimize)
+        self._update_lora_params({
             "crc": crc,
             "invert_iq": invert_iq,
             "low_data_rate_optimize": low_data_rate_optimize,
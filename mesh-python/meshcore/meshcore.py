@@ -4,6 +4,7 @@ import enum
 import dataclasses
 from typing import Self
 import datetime
+import base64
 import queue
 import cryptography.hazmat.primitives.ciphers
 import cryptography.hazmat.primitives.hashes
@@ -11,6 +12,13 @@ import cryptography.hazmat.primitives.hmac
 import cryptography.hazmat.primitives.constant_time
 import cryptography.hazmat.primitives.asymmetric.ed25519
 import time
+import threading
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import random
+import sys
 from .. import lora_modem
 
 _logger = logging.getLogger(__name__)
@@ -18,6 +26,11 @@ _logger = logging.getLogger(__name__)
 MAX_PATH_SIZE = 64
 MAX_PACKET_PAYLOAD = 184
 
+_U16_U16 = struct.Struct("<HH")
+_U32 = struct.Struct("<I")
+_U32_U32_U8 = struct.Struct("<IIB")
+_U32_U32 = struct.Struct("<II")
+
 class JSONEnum(enum.Enum):
     def key_to_json(self):
         return self.name
@@ -61,47 +74,231 @@ class AdvertNodeType(JSONEnum):
     ROOM_SERVER = 0x3
     SENSOR = 0x4
 
-@dataclasses.dataclass
-class MeshcoreDataclass:
-    def _serialize_dict_value(self, key, value):
-        if isinstance(value, MeshcoreDataclass):
-            return value.serialize_dict()
-        if isinstance(value, bytes):
-            return list(value)
-        if isinstance(value, datetime.datetime):
-            return value.isoformat()
-        if isinstance(value, JSONEnum):
-            return value.key_to_json()
+def _bytes_hex(value) -> str:
+    return value.hex()
+
+
+def _bytes_base64(value) -> str:
+    return base64.b64encode(value).decode("ascii")
+
+
+_BYTES_FORMATS = {
+    "hex": _bytes_hex,
+    "base64": _bytes_base64,
+}
+
+
+def _serialize_value(value, bytes_fn):
+    if value is None or type(value) in _PLAIN_TYPES:
         return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes_fn(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, JSONEnum):
+        return value.key_to_json()
+    if isinstance(value, (list, tuple)):
+        return [_serialize_value(x, bytes_fn) for x in value]
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return _get_serializer(type(value))(value, bytes_fn)
+    return value
+
+
+_PLAIN_TYPES = frozenset([int, float, str, bool])
+_serializers = {}
+
+
+def _get_serializer(cls):
+    """
+    Serializer for one dataclass, generated once from its fields. Fields with metadata {"serialize": False}
+    are left out, names in the class' _serialize_extra (e.g. properties) are added.
+    """
+    fn = _serializers.get(cls)
+    if fn is None:
+        names = [f.name for f in dataclasses.fields(cls) if f.metadata.get("serialize", True)]
+        names += getattr(cls, "_serialize_extra", ())
+        items = ", ".join(f"{name!r}: _serialize_value(obj.{name}, bytes_fn)" for name in names)
+        namespace = {"_serialize_value": _serialize_value}
+        exec(f"def _serialize(obj, bytes_fn):\n    return {{{items}}}\n", namespace)
+        fn = _serializers[cls] = namespace["_serialize"]
+    return fn
+
+
+def serialize_dict(obj, bytes_format: str = "hex") -> dict:
+    """
+    JSON compatible dict of a dataclass (MeshcoreDataclass, LoraPacketReceived, ...), bytes become hex or base64 strings
+    """
+    return _get_serializer(type(obj))(obj, _BYTES_FORMATS[bytes_format])
+
+
+def json_default(obj):
+    """
+    for json.dumps(..., default=json_default) / json.JSONEncoder(default=json_default).iterencode(...),
+    so packets can be streamed into a JSON encoder without building the whole dict tree first
+    """
+    value = _serialize_value(obj, _bytes_hex)
+    if value is obj:
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+    return value
+
+
+@dataclasses.dataclass(slots=True)
+class MeshcoreDataclass:
+    def serialize_dict(self, bytes_format: str = "hex") -> dict:
+        return serialize_dict(self, bytes_format)
+
+
+@dataclasses.dataclass
+class _ChannelCipher:
+    """
+    key material of a channel, prepared once so decoding doesn't redo it for every packet
+    """
+    channel_key: object
+    key: bytes
+    hmac: cryptography.hazmat.primitives.hmac.HMAC # keyed but unused, copy() it
+    cipher: cryptography.hazmat.primitives.ciphers.Cipher
+
+    @classmethod
+    def from_key(cls, channel_key: object, key: bytes) -> Self:
+        if len(key) != 16:
+            raise Exception(f"channel key is {len(key)} bytes - not 16 bytes")
+        return cls(
+            channel_key=channel_key,
+            key=key,
+            hmac=cryptography.hazmat.primitives.hmac.HMAC(key, cryptography.hazmat.primitives.hashes.SHA256()),
+            cipher=cryptography.hazmat.primitives.ciphers.Cipher(
+                cryptography.hazmat.primitives.ciphers.algorithms.AES(key),
+                cryptography.hazmat.primitives.ciphers.modes.ECB(),
+            ),
+        )
+
+    def mac(self, data: bytes) -> bytes:
+        hmac = self.hmac.copy()
+        hmac.update(data)
+        return hmac.finalize()[:2]
+
+    def decrypt(self, data: bytes) -> bytes:
+        decryptor = self.cipher.decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+
+
+class AdvertVerifier:
+    """
+    Ed25519 signature checks for adverts, with a bounded cache of adverts that verified fine so the same advert
+    heard again (other paths, other nodes, after the heard cache forgot it) isn't verified again.
+    """
+
+    def __init__(self, max_cache: int = 4096):
+        self.max_cache = max_cache
+        self._lock = threading.Lock()
+        self._verified = collections.OrderedDict() # (pubkey, timestamp, digest) -> None, least recently used first
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "invalid": 0,
+            "verify_secs": 0.0,
+        }
+
+    def verify(self, pubkey: bytes, timestamp: int, signature: bytes, signed_data: bytes) -> None:
+        """
+        raises cryptography.exceptions.InvalidSignature if the signature doesn't match
+        """
+        # the digest covers the signed data too, a cached entry must not vouch for altered content
+        sha256hash = cryptography.hazmat.primitives.hashes.Hash(cryptography.hazmat.primitives.hashes.SHA256())
+        sha256hash.update(signature)
+        sha256hash.update(signed_data)
+        key = (pubkey, timestamp, sha256hash.finalize())
+        with self._lock:
+            if key in self._verified:
+                self._verified.move_to_end(key)
+                self.stats["hits"] += 1
+                return
+            self.stats["misses"] += 1
+
+        tstart = time.perf_counter()
+        try:
+            public_key = cryptography.hazmat.primitives.asymmetric.ed25519.Ed25519PublicKey.from_public_bytes(pubkey)
+            public_key.verify(signature, signed_data)
+        except:
+            with self._lock:
+                self.stats["invalid"] += 1
+            raise
+        finally:
+            tdelta = time.perf_counter() - tstart
+            with self._lock:
+                self.stats["verify_secs"] += tdelta
 
-    def serialize_dict(self) -> dict:
-        out = {}
-        for k, v in dataclasses.asdict(self).items():
-            out[k] = self._serialize_dict_value(k, v)
-        return out
+        with self._lock:
+            self._verified[key] = None
+            while len(self._verified) > self.max_cache:
+                self._verified.popitem(last=False)
+
+
+_default_advert_verifier = None
+_default_advert_verifier_lock = threading.Lock()
+
+
+def default_advert_verifier() -> AdvertVerifier:
+    """
+    signatures are the same for everyone, so nodes share one verifier unless told otherwise
+    """
+    global _default_advert_verifier
+    with _default_advert_verifier_lock:
+        if _default_advert_verifier is None:
+            _default_advert_verifier = AdvertVerifier()
+        return _default_advert_verifier
 
 
 class MeshcoreNode:
-    def __init__(self, channels = None):
-        self.channels = channels
-        if self.channels is None:
+    def __init__(self, channels = None, advert_verifier: AdvertVerifier | None = None):
+        self.advert_verifier = advert_verifier if advert_verifier is not None else default_advert_verifier()
+        if channels is None:
             def _hashtag_key(name: str) -> bytes:
                 sha256hash = cryptography.hazmat.primitives.hashes.Hash(cryptography.hazmat.primitives.hashes.SHA256())
                 sha256hash.update(name.lower().encode("utf-8"))
                 sha256_key = sha256hash.finalize()
                 return sha256_key[:16]
 
-            self.channels = {
+            channels = {
                 "Public": bytes.fromhex("8b3387e9c5cdea6ac9e5edbaa115cd72"),
                 "#test": _hashtag_key("#test"),
                 "#ping": _hashtag_key("#ping"),
             }
+        self.channels = channels
+
+    @property
+    def channels(self) -> dict[str, bytes]:
+        return self._channels
+
+    @channels.setter
+    def channels(self, channels: dict[str, bytes]):
+        # assign a new dict to change channels, modifying it in place doesn't rebuild the index
+        self._channels = channels
+        self._channel_index = None
 
     def get_channels(self) -> dict[str, bytes]:
         return self.channels
 
+    def _build_channel_index(self) -> dict[int, list[_ChannelCipher]]:
+        index = {}
+        for channel_key, key in self._channels.items():
+            channel = _ChannelCipher.from_key(channel_key, key)
+            sha256hash = cryptography.hazmat.primitives.hashes.Hash(cryptography.hazmat.primitives.hashes.SHA256())
+            sha256hash.update(key)
+            index.setdefault(sha256hash.finalize()[0], []).append(channel)
+        return index
+
+    def get_channel_candidates(self, channel_hash: int) -> list[_ChannelCipher]:
+        """
+        channels whose 1 byte hash matches, only these can have encrypted a GRP_TXT with that hash
+        """
+        index = self._channel_index
+        if index is None:
+            index = self._channel_index = self._build_channel_index()
+        return index.get(channel_hash, [])
 
-@dataclasses.dataclass
+
+@dataclasses.dataclass(slots=True)
 class Payload(MeshcoreDataclass):
     @classmethod
     def deserialize(cls, node: MeshcoreNode, data: bytes) -> Self:
@@ -110,19 +307,58 @@ class Payload(MeshcoreDataclass):
     def serialize(self) -> bytes:
         raise NotImplementedError()
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class PayloadRaw(Payload):
     data: bytes
 
     @classmethod
     def deserialize(cls, node: MeshcoreNode, data: bytes) -> Self:
-        return cls(data)
+        return cls(bytes(data))
 
     def serialize(self) -> bytes:
         return self.data
 
 
-@dataclasses.dataclass
+# Payloads that are decoded but stored as raw data, data stays the full payload.
+# https://github.com/meshcore-dev/MeshCore/blob/6b52fb32301c273fc78d96183501eb23ad33c5bb/docs/payloads.md
+
+@dataclasses.dataclass(slots=True)
+class PayloadAck(PayloadRaw):
+    checksum: int # CRC of the acknowledged message's timestamp, text and sender pubkey
+
+    @classmethod
+    def deserialize(cls, node: MeshcoreNode, data: bytes) -> Self:
+        checksum, = _U32.unpack_from(data, 0)
+        return cls(bytes(data), checksum)
+
+
+@dataclasses.dataclass(slots=True)
+class PayloadPath(PayloadRaw):
+    # the returned path itself is encrypted with the shared secret of src and dest, only the hashes are readable
+    dest_hash: int
+    src_hash: int
+
+    @classmethod
+    def deserialize(cls, node: MeshcoreNode, data: bytes) -> Self:
+        if len(data) < 4:
+            raise Exception("PATH payload too short")
+        return cls(bytes(data), data[0], data[1])
+
+
+@dataclasses.dataclass(slots=True)
+class PayloadTrace(PayloadRaw):
+    tag: int
+    auth_code: int
+    flags: int
+    path_hashes: list[int] # repeaters the trace is sent along, the packet path holds the SNR (x4) per hop instead
+
+    @classmethod
+    def deserialize(cls, node: MeshcoreNode, data: bytes) -> Self:
+        tag, auth_code, flags = _U32_U32_U8.unpack_from(data, 0)
+        return cls(bytes(data), tag, auth_code, flags, list(data[_U32_U32_U8.size:]))
+
+
+@dataclasses.dataclass(slots=True)
 class PayloadGroupText(Payload):
     channel_key: object
     timestamp: datetime.datetime
@@ -131,56 +367,42 @@ class PayloadGroupText(Payload):
 
     @classmethod
     def deserialize(cls, node: MeshcoreNode, data: bytes) -> Self:
-        channel_hash = int(data[0])
-        cipher_mac = data[1:3]
+        channel_hash = data[0]
+        cipher_mac = bytes(data[1:3])
         ciphertext = data[3:]
 
-        _logger.debug("channel_hash: %s, cipher_mac: %s, ciphertext: %s", channel_hash, cipher_mac, ciphertext)
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug("channel_hash: %s, cipher_mac: %s, ciphertext: %s", channel_hash, cipher_mac, bytes(ciphertext))
 
-        for channel_key, key in node.get_channels().items():
-            if len(key) != 16:
-                raise Exception(f"channel key is {len(key)} bytes - not 16 bytes")
-            sha256hash = cryptography.hazmat.primitives.hashes.Hash(cryptography.hazmat.primitives.hashes.SHA256())
-            sha256hash.update(key)
-            sha256_key = sha256hash.finalize()
-            if sha256_key[0] == channel_hash:
-                _logger.debug("found channel with matching hash")
-                hmac = cryptography.hazmat.primitives.hmac.HMAC(key, cryptography.hazmat.primitives.hashes.SHA256())
-                hmac.update(ciphertext)
-                calculated_mac = hmac.finalize()[:2]
-
-                if not cryptography.hazmat.primitives.constant_time.bytes_eq(calculated_mac, cipher_mac):
-                    _logger.debug("mac mismatch calculated: %s got: %s", calculated_mac, cipher_mac)
-                    continue
-
-                cipher = cryptography.hazmat.primitives.ciphers.Cipher(
-                    cryptography.hazmat.primitives.ciphers.algorithms.AES(key),
-                    cryptography.hazmat.primitives.ciphers.modes.ECB(),
-                )
-
-                decryptor = cipher.decryptor()
-                decrypted = decryptor.update(ciphertext) + decryptor.finalize()
-
-                timestamp, = struct.unpack_from("<I", decrypted[0:4])
-                attempt_num = int(decrypted[4]) & 0x3
-                txt_type = (int(decrypted[4]) >> 2) & 0x3F
-                # stripping the trailing zeros, those are left in because AES runs in blocks or something idk
-                full_msg = bytearray(decrypted[5:]).rstrip(b"\x00").decode("utf-8")
-
-                full_msg_split = full_msg.split(": ", maxsplit=1)
-
-                kwargs = {
-                    "channel_key": channel_key,
-                    "timestamp": datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc),
-                    "sender_name": full_msg_split[0],
-                    "message": full_msg_split[1],
-                }
-                return cls(**kwargs)
+        for channel in node.get_channel_candidates(channel_hash):
+            _logger.debug("found channel with matching hash")
+            calculated_mac = channel.mac(ciphertext)
+            if not cryptography.hazmat.primitives.constant_time.bytes_eq(calculated_mac, cipher_mac):
+                _logger.debug("mac mismatch calculated: %s got: %s", calculated_mac, cipher_mac)
+                continue
+
+            decrypted = channel.decrypt(ciphertext)
+
+            timestamp, = _U32.unpack_from(decrypted, 0)
+            attempt_num = int(decrypted[4]) & 0x3
+            txt_type = (int(decrypted[4]) >> 2) & 0x3F
+            # stripping the trailing zeros, those are left in because AES runs in blocks or something idk
+            full_msg = decrypted[5:].rstrip(b"\x00").decode("utf-8")
+
+            full_msg_split = full_msg.split(": ", maxsplit=1)
+
+            kwargs = {
+                "channel_key": channel.channel_key,
+                "timestamp": datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc),
+                "sender_name": full_msg_split[0],
+                "message": full_msg_split[1],
+            }
+            return cls(**kwargs)
 
         raise Exception("could not decrypt")
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class PayloadAdvert(Payload):
     pubkey: bytes
     timestamp: datetime.datetime
@@ -190,24 +412,17 @@ class PayloadAdvert(Payload):
 
     @classmethod
     def deserialize(cls, node: MeshcoreNode, data: bytes) -> Self:
-        def _verify_signature(data, pubkey, signature):
-            data_nokey = bytearray(data)
-            # signing happens without the pubkey present in the message
-            # https://github.com/meshcore-dev/MeshCore/blob/10067ada182e8fccd61406bb6c2e036c33d92e09/src/Mesh.cpp#L420-L428
-            data_nokey[32 + 4:32 + 4 + 64] = []
-            public_key = cryptography.hazmat.primitives.asymmetric.ed25519.Ed25519PublicKey.from_public_bytes(pubkey)
-            public_key.verify(signature, data_nokey)
-
         kwargs = {}
         byte_idx = 0
 
-        kwargs["pubkey"] = data[byte_idx:byte_idx+32]
+        kwargs["pubkey"] = bytes(data[byte_idx:byte_idx+32])
         byte_idx += 32
 
-        kwargs["timestamp"] = datetime.datetime.fromtimestamp(struct.unpack_from("<I", data[byte_idx:byte_idx+4])[0], tz=datetime.timezone.utc)
+        timestamp, = _U32.unpack_from(data, byte_idx)
+        kwargs["timestamp"] = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
         byte_idx += 4
 
-        signature = data[byte_idx:byte_idx+64]
+        signature = bytes(data[byte_idx:byte_idx+64])
         byte_idx += 64
 
         flags = data[byte_idx]
@@ -224,10 +439,8 @@ class PayloadAdvert(Payload):
         NAME_MASK = 0x80
 
         if (flags & LATLON_MASK) != 0:
-            lat = struct.unpack_from("<I", data[byte_idx:byte_idx+4])[0]
-            byte_idx += 4
-            lon = struct.unpack_from("<I", data[byte_idx:byte_idx+4])[0]
-            byte_idx += 4
+            lat, lon = _U32_U32.unpack_from(data, byte_idx)
+            byte_idx += 8
             kwargs["lat_lon"] = (lat / 1000000, lon / 1000000)
         else:
             kwargs["lat_lon"] = None
@@ -239,36 +452,78 @@ class PayloadAdvert(Payload):
             byte_idx += 2
         
         if (flags & NAME_MASK) != 0:
-            kwargs["name"] = data[byte_idx:].decode("utf-8")
+            kwargs["name"] = str(data[byte_idx:], "utf-8")
         else:
             kwargs["name"] = None
         
-        _verify_signature(data, kwargs["pubkey"], signature)
+        # signing happens without the pubkey present in the message
+        # https://github.com/meshcore-dev/MeshCore/blob/10067ada182e8fccd61406bb6c2e036c33d92e09/src/Mesh.cpp#L420-L428
+        signed_data = b"".join((data[:32 + 4], data[32 + 4 + 64:]))
+        node.advert_verifier.verify(kwargs["pubkey"], timestamp, signature, signed_data)
 
         return cls(**kwargs)
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class MeshcorePacket(MeshcoreDataclass):
     route_type: RouteType
     payload_type: PayloadType
     payload_version: PayloadVersion
     transport_codes: list[int] | None
     path: list[int]
-    payload: Payload
     hash: bytes  # TODO: proper hashing thing, this only works for RX, make the hash a getter maybe..?
+    # the payload is only decoded (decrypted, signature checked) when payload is first accessed
+    raw_payload: bytes = dataclasses.field(repr=False, metadata={"serialize": False})
+    node: MeshcoreNode = dataclasses.field(repr=False, compare=False, metadata={"serialize": False})
+    _payload: Payload | None = dataclasses.field(default=None, init=False, repr=False, compare=False, metadata={"serialize": False})
+
+    _serialize_extra = ("payload",)
+
+    @property
+    def payload(self) -> Payload:
+        # decoding twice when two threads race here is harmless
+        if self._payload is None:
+            self._payload = self._decode_payload()
+        return self._payload
+
+    @property
+    def trace_snrs(self) -> list[float] | None:
+        """
+        SNR (dB) for every hop a TRACE went through so far, None for other packets
+        """
+        if self.payload_type != PayloadType.TRACE:
+            return None
+        return [(x - 256 if x > 127 else x) / 4 for x in self.path]
+
+    def _decode_payload(self) -> Payload:
+        PAYLOAD_CLASS_LOOKUP = {
+            PayloadType.ADVERT: PayloadAdvert,
+            PayloadType.GRP_TXT: PayloadGroupText,
+            PayloadType.ACK: PayloadAck,
+            PayloadType.PATH: PayloadPath,
+            PayloadType.TRACE: PayloadTrace,
+        }
+
+        try:
+            return PAYLOAD_CLASS_LOOKUP.get(self.payload_type, PayloadRaw).deserialize(self.node, self.raw_payload)
+        except:
+            _logger.exception("error deserializing")
+            return PayloadRaw.deserialize(self.node, self.raw_payload)
 
     @classmethod
     def deserialize(cls, node: MeshcoreNode, data: bytes) -> Self:
         # https://github.com/meshcore-dev/MeshCore/blob/6b52fb32301c273fc78d96183501eb23ad33c5bb/docs/packet_structure.md
+        # fields are read in place with unpack_from, the payload is kept as a view without copying it
+        # only the header, path and hash are decoded here, that's all the repeater needs
         kwargs = {}
 
         byte_idx = 0
 
         # header field
-        kwargs["route_type"] = RouteType(int(data[byte_idx]) & 0x3)
-        kwargs["payload_type"] = PayloadType((int(data[byte_idx]) >> 2) & 0xF)
-        kwargs["payload_version"] = PayloadVersion((int(data[byte_idx]) >> 6) & 0x3)
+        header = data[byte_idx]
+        kwargs["route_type"] = RouteType(header & 0x3)
+        kwargs["payload_type"] = PayloadType((header >> 2) & 0xF)
+        kwargs["payload_version"] = PayloadVersion((header >> 6) & 0x3)
         if kwargs["payload_version"] != PayloadVersion.V0:
             raise Exception(f"unsupported payload version {kwargs['payload_version']}")
         byte_idx += 1
@@ -276,61 +531,417 @@ class MeshcorePacket(MeshcoreDataclass):
         # transport codes
         kwargs["transport_codes"] = None
         if kwargs["route_type"] in [RouteType.TRANSPORT_FLOOD, RouteType.TRANSPORT_DIRECT]:
-            t1, t2 = struct.unpack_from("<HH", data[byte_idx:byte_idx+4])
-            kwargs["transport_codes"] = [t1, t2]
+            kwargs["transport_codes"] = list(_U16_U16.unpack_from(data, byte_idx))
             byte_idx += 4
 
         # path len
-        path_len = int(data[byte_idx])
+        path_len = data[byte_idx]
         byte_idx += 1
 
         # path
         if path_len > MAX_PATH_SIZE:
             raise Exception("MAX_PATH_SIZE exceeded")
-        kwargs["path"] = []
-        for _ in range(path_len):
-            kwargs["path"].append(int(data[byte_idx]))
-            byte_idx += 1
+        if byte_idx + path_len > len(data):
+            raise Exception("packet shorter than path_len")
+        kwargs["path"] = list(data[byte_idx:byte_idx+path_len])
+        byte_idx += path_len
 
-        payload_bytes = data[byte_idx:]
+        payload_bytes = memoryview(data)[byte_idx:]
         if len(payload_bytes) > MAX_PACKET_PAYLOAD:
             raise Exception("MAX_PACKET_PAYLOAD exceeded")
 
         # calculate hash from payload type & payload data
         sha256hash = cryptography.hazmat.primitives.hashes.Hash(cryptography.hazmat.primitives.hashes.SHA256())
-        sha256hash.update(bytes([kwargs["payload_type"].value]))
+        sha256hash.update(bytes((kwargs["payload_type"].value,)))
         sha256hash.update(payload_bytes)
         kwargs["hash"] = sha256hash.finalize()
 
-        PAYLOAD_CLASS_LOOKUP = {
-            PayloadType.ADVERT: PayloadAdvert,
-            PayloadType.GRP_TXT: PayloadGroupText,
+        kwargs["raw_payload"] = payload_bytes
+        kwargs["node"] = node
+
+        return cls(**kwargs)
+
+
+@dataclasses.dataclass(slots=True)
+class _Route:
+    path: list[int]
+    learned: float
+
+
+class RouteTable:
+    """
+    Direct routes learned from flood traffic. A flood packet collects the hash of every repeater it went through,
+    so the reversed path of an advert (or PATH return) from a node is a working direct route back to it.
+    Routes by pubkey come from adverts, PATH packets only carry the 1 byte hash of their sender which is
+    resolved to a pubkey if only one known node has that hash.
+    """
+
+    def __init__(self, max_age_secs: float = 24 * 60 * 60, clock=time.monotonic):
+        self.max_age_secs = max_age_secs
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._by_pubkey = {}
+        self._by_hash = {}
+        self._pubkeys_by_hash = {} # hash -> set of pubkeys we've seen adverts from
+
+    def _update(self, routes: dict, key, path: list[int], now: float) -> bool:
+        route = routes.get(key)
+        # keep the shorter route unless it got stale
+        if route is not None and now - route.learned < self.max_age_secs and len(route.path) < len(path):
+            return False
+        changed = route is None or route.path != path
+        routes[key] = _Route(path, now)
+        return changed
+
+    def _resolve_hash(self, hash_: int) -> bytes | None:
+        pubkeys = self._pubkeys_by_hash.get(hash_)
+        if pubkeys is None or len(pubkeys) != 1:
+            return None
+        return next(iter(pubkeys))
+
+    def learn(self, packet: MeshcorePacket) -> list[tuple[bytes, list[int]]]:
+        """
+        Learn from a received packet (decodes the payload for adverts and PATH packets).
+        Returns the (pubkey, out_path) pairs whose route changed.
+        """
+        if packet.route_type not in [RouteType.FLOOD, RouteType.TRANSPORT_FLOOD]:
+            return []
+        if packet.payload_type not in [PayloadType.ADVERT, PayloadType.PATH]:
+            return []
+        payload = packet.payload
+        out_path = packet.path[::-1]
+        now = self._clock()
+        updates = []
+        with self._lock:
+            if isinstance(payload, PayloadAdvert):
+                self._pubkeys_by_hash.setdefault(payload.pubkey[0], set()).add(payload.pubkey)
+                if self._update(self._by_pubkey, payload.pubkey, out_path, now):
+                    updates.append((payload.pubkey, out_path))
+            elif isinstance(payload, PayloadPath):
+                if self._update(self._by_hash, payload.src_hash, out_path, now):
+                    pubkey = self._resolve_hash(payload.src_hash)
+                    if pubkey is not None and self._update(self._by_pubkey, pubkey, out_path, now):
+                        updates.append((pubkey, out_path))
+        return updates
+
+    def get(self, pubkey: bytes) -> list[int] | None:
+        now = self._clock()
+        with self._lock:
+            route = self._by_pubkey.get(pubkey)
+            if route is None and self._resolve_hash(pubkey[0]) == pubkey:
+                route = self._by_hash.get(pubkey[0])
+            if route is None or now - route.learned >= self.max_age_secs:
+                return None
+            return route.path
+
+    def route_for(self, pubkey: bytes) -> tuple[RouteType, list[int]]:
+        """
+        how to send something to pubkey, DIRECT along a learned route or FLOOD if we don't know one
+        """
+        path = self.get(pubkey)
+        if path is None:
+            return (RouteType.FLOOD, [])
+        return (RouteType.DIRECT, path)
+
+
+class HeardCache:
+    """
+    Packet hashes (or any other packet key) seen recently, used to not process/repeat the same flood packet twice.
+    Hashes are forgotten once there are more than max_count or they are older than max_age_secs.
+    Thread safe, so one cache can be shared by Meshcore instances listening on the same frequency.
+    """
+
+    def __init__(self, max_count: int = 16384, max_age_secs: float = 30 * 60, clock=time.monotonic):
+        self.max_count = max_count
+        self.max_age_secs = max_age_secs
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._hashes = collections.OrderedDict() # hash -> time first heard, oldest first
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
         }
 
-        try:
-            kwargs["payload"] = PAYLOAD_CLASS_LOOKUP.get(kwargs["payload_type"], PayloadRaw).deserialize(node, payload_bytes)
-        except:
-            _logger.exception("error deserializing")
-            kwargs["payload"] = PayloadRaw.deserialize(node, payload_bytes)
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def __contains__(self, hash_: bytes) -> bool:
+        with self._lock:
+            self._evict(self._clock())
+            return hash_ in self._hashes
+
+    def memory_bytes(self) -> int:
+        """
+        rough memory use of the stored entries
+        """
+        with self._lock:
+            if not self._hashes:
+                return sys.getsizeof(self._hashes)
+            hash_, t = next(iter(self._hashes.items()))
+            return sys.getsizeof(self._hashes) + len(self._hashes) * (sys.getsizeof(hash_) + sys.getsizeof(t))
+
+    def _evict(self, now: float):
+        hashes = self._hashes
+        t_limit = now - self.max_age_secs
+        while hashes and (len(hashes) > self.max_count or next(iter(hashes.values())) < t_limit):
+            hashes.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def check_and_add(self, hash_: bytes) -> bool:
+        """
+        returns True if the hash was heard before, otherwise remembers it and returns False
+        """
+        with self._lock:
+            now = self._clock()
+            self._evict(now)
+            if hash_ in self._hashes:
+                self.stats["hits"] += 1
+                return True
+            self.stats["misses"] += 1
+            self._hashes[hash_] = now
+            if len(self._hashes) > self.max_count:
+                self._evict(now)
+            return False
+
+
+_shared_heard_caches = {}
+_shared_heard_caches_lock = threading.Lock()
+
+
+def shared_heard_cache(frequency: int, **kwargs) -> HeardCache:
+    """
+    the HeardCache shared by everything listening on frequency, kwargs are only used when it is created
+    """
+    with _shared_heard_caches_lock:
+        cache = _shared_heard_caches.get(frequency)
+        if cache is None:
+            cache = _shared_heard_caches[frequency] = HeardCache(**kwargs)
+        return cache
+
+
+@dataclasses.dataclass(order=True)
+class _ScheduledCall:
+    t: float
+    seq: int
+    fn: object = dataclasses.field(compare=False)
+    cancelled: bool = dataclasses.field(default=False, compare=False)
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class CallScheduler:
+    """
+    Runs functions after a delay on its own thread, used to hold back repeats without blocking RX.
+    Anything with a compatible call_later (e.g. virtual_lora.VirtualAir for simulated time) can be used instead.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._calls = []
+        self._seq = itertools.count()
+        self._thread = None
+        self._thread_stop = False
+
+    def call_later(self, delay: float, fn) -> _ScheduledCall:
+        """
+        call fn after delay seconds, the returned handle can be used to cancel() it
+        """
+        call = _ScheduledCall(self._clock() + delay, next(self._seq), fn)
+        with self._cond:
+            heapq.heappush(self._calls, call)
+            self._cond.notify_all()
+        return call
+
+    def start(self) -> None:
+        self._thread_stop = False
+        self._thread = threading.Thread(target=self._run, name="meshcore-scheduler")
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._thread_stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._thread_stop:
+                        self._calls = []
+                        return
+                    if self._calls and self._calls[0].cancelled:
+                        heapq.heappop(self._calls)
+                        continue
+                    if not self._calls:
+                        self._cond.wait()
+                        continue
+                    wait = self._calls[0].t - self._clock()
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    call = heapq.heappop(self._calls)
+                    break
+            try:
+                call.fn()
+            except:
+                _logger.exception("scheduled call exception")
+
+
+@dataclasses.dataclass
+class _PendingRepeat:
+    path_len: int # path length when we heard it, repeats by others have at least this path length
+    call: object # scheduler handle
+    tx_future: concurrent.futures.Future | None = None
 
-        return cls(**kwargs)
 
 class Meshcore:
-    def __init__(self, modem: lora_modem.LoraModem, node: MeshcoreNode, received_msg_queue: queue.SimpleQueue | None = None):
+    # how often a repeat is retried when the modem couldn't get a free channel
+    REPEAT_CAD_RETRIES = 1
+    # flood packets that already went through this many hops aren't repeated anymore
+    MAX_FLOOD_HOPS = MAX_PATH_SIZE
+    # Retransmit delay like the MeshCore firmware, see Dispatcher::calcRxDelay and Mesh::getRetransmitDelay.
+    # An SNR based part, (RX_DELAY_BASE^(0.85 - score) - 1) * airtime, 0 disables it,
+    # and a random part of up to 5 * airtime * TX_DELAY_FACTOR so neighbours don't all repeat at once.
+    RX_DELAY_BASE = 10.0
+    TX_DELAY_FACTOR = 0.5
+
+    def __init__(
+        self,
+        modem: lora_modem.LoraModem,
+        node: MeshcoreNode,
+        received_msg_queue: queue.SimpleQueue | None = None,
+        heard_cache: HeardCache | None = None,
+        scheduler=None,
+        rng: random.Random | None = None,
+        routes: RouteTable | None = None,
+    ):
         self.modem = modem
         self.node = node
         self._received_msg_queue = received_msg_queue
-        self._head_packet_hashes = []
+        self.heard_cache = heard_cache if heard_cache is not None else HeardCache()
+        # filled by whoever consumes received packets (see learn_routes), decoding payloads doesn't belong on the RX thread
+        self.routes = routes if routes is not None else RouteTable()
+        self._own_scheduler = scheduler is None
+        self._scheduler = scheduler if scheduler is not None else CallScheduler()
+        self._rng = rng if rng is not None else random.Random()
+        self._repeat_pending = {} # packet hash -> _PendingRepeat
+        self._repeat_pending_lock = threading.Lock()
+        self.repeat_stats = {
+            "scheduled": 0,
+            "cancelled": 0,
+            "hop_limit": 0,
+            "not_flood": 0,
+        }
 
     def _check_heard(self, hash_: bytes):
-        if hash_ in self._head_packet_hashes:
-            return True
-        self._head_packet_hashes.append(hash_)
-        # https://github.com/meshcore-dev/MeshCore/blob/f903c50e9d62e8f4cf0764036ac7de5a795bccf5/src/helpers/SimpleMeshTables.h#L9
-        MAX_HEARD = 128
-        if len(self._head_packet_hashes) > MAX_HEARD:
-            self._head_packet_hashes = self._head_packet_hashes[-MAX_HEARD:]
-        return False
+        return self.heard_cache.check_and_add(hash_)
+
+    def learn_routes(self, packet: MeshcorePacket) -> list[tuple[bytes, list[int]]]:
+        return self.routes.learn(packet)
+
+    def _repeat(self, p: lora_modem.LoraPacketReceived, full_pwr: bool, attempt: int = 0) -> concurrent.futures.Future:
+        if full_pwr:
+            _logger.debug("repeating this packet with full power")
+        # TX power only for this frame, the modem default stays untouched
+        tx_p = lora_modem.LoraPacket(p.data, tx_power=20 if full_pwr else 0)
+        tx_future = self.modem.tx(tx_p, lora_modem.TxPriority.REPEAT)
+
+        def _done(f):
+            if f.cancelled() or f.exception() is not None:
+                return
+            res = f.result()
+            if res.success:
+                _logger.debug("repeated packet (latency %ss)", res.latency)
+                return
+            _logger.debug("repeating packet failed: %s", res.reason)
+            if res.reason == "cadTimeout" and attempt < self.REPEAT_CAD_RETRIES:
+                self._repeat(p, full_pwr, attempt + 1)
+
+        tx_future.add_done_callback(_done)
+        return tx_future
+
+    @staticmethod
+    def _packet_score(snr: float, spreading_factor: int, packet_len: int) -> float:
+        # RadioLibWrapper::packetScoreInt, 0 (barely decodable) to 1 (clean)
+        threshold = -7.5 - 2.5 * (spreading_factor - 7)
+        if snr < threshold:
+            return 0.0
+        return max(0.0, min(1.0, ((snr - threshold) / 10) * (1 - (packet_len / 256))))
+
+    def _repeat_delay(self, p: lora_modem.LoraPacketReceived) -> float:
+        airtime = float(self.modem.calc_airtime_bulk([len(p.data)])[0])
+        delay = 0.0
+        if self.RX_DELAY_BASE > 0:
+            sf = self.modem.get_lora_params()["spreading_factor"]
+            score = self._packet_score(p.snr, sf, len(p.data))
+            delay += max(0.0, ((self.RX_DELAY_BASE ** (0.85 - score)) - 1) * airtime)
+        delay += self._rng.uniform(0, 5 * airtime * self.TX_DELAY_FACTOR)
+        return delay
+
+    def _should_repeat(self, packet: MeshcorePacket) -> bool:
+        # we don't have an identity, so direct packets are never addressed to us
+        if packet.route_type not in [RouteType.FLOOD, RouteType.TRANSPORT_FLOOD]:
+            self.repeat_stats["not_flood"] += 1
+            return False
+        if len(packet.path) >= self.MAX_FLOOD_HOPS:
+            self.repeat_stats["hop_limit"] += 1
+            return False
+        return True
+
+    def _schedule_repeat(self, p: lora_modem.LoraPacketReceived, packet: MeshcorePacket):
+        # repeat packets that come from closeby nodes with high TX power, everything else with low TX power (rooftop repeater sorta deal)
+        full_pwr = p.rssi > -80
+        delay = self._repeat_delay(p)
+        _logger.debug("repeating in %fs", delay)
+        pending = _PendingRepeat(len(packet.path), None)
+        with self._repeat_pending_lock:
+            self._repeat_pending[packet.hash] = pending
+            self.repeat_stats["scheduled"] += 1
+        pending.call = self._scheduler.call_later(delay, lambda: self._repeat_due(packet.hash, pending, p, full_pwr))
+
+    def _repeat_due(self, hash_: bytes, pending: _PendingRepeat, p: lora_modem.LoraPacketReceived, full_pwr: bool):
+        with self._repeat_pending_lock:
+            if self._repeat_pending.get(hash_) is not pending:
+                return
+        # not under the lock, TX future callbacks may run right away and take it
+        tx_future = self._repeat(p, full_pwr)
+        with self._repeat_pending_lock:
+            still_pending = self._repeat_pending.get(hash_) is pending
+            if still_pending:
+                pending.tx_future = tx_future
+        if not still_pending:
+            # cancelled while we were queueing it
+            tx_future.cancel()
+            return
+
+        def _done(f):
+            with self._repeat_pending_lock:
+                if self._repeat_pending.get(hash_) is pending:
+                    del self._repeat_pending[hash_]
+
+        tx_future.add_done_callback(_done)
+
+    def _cancel_repeat(self, packet: MeshcorePacket):
+        """
+        somebody else repeated this packet before we did, no need to add to the noise
+        """
+        with self._repeat_pending_lock:
+            pending = self._repeat_pending.get(packet.hash)
+            # a copy with a shorter path is from before us in the chain, it doesn't mean our neighbours got it
+            if pending is None or len(packet.path) < pending.path_len:
+                return
+            del self._repeat_pending[packet.hash]
+            pending.call.cancel()
+            if pending.tx_future is not None:
+                pending.tx_future.cancel()
+            self.repeat_stats["cancelled"] += 1
+        _logger.debug("repeat cancelled, heard it from another repeater")
 
     def start(self):
         def rx_cb(p):
@@ -339,25 +950,24 @@ class Meshcore:
             _logger.debug("deserialized: %s - %s", packet, "heard before" if heard else "new packet")
             if self._received_msg_queue is not None:
                 self._received_msg_queue.put((p, packet, heard))
-            # repeat packets that come from closeby nodes with high TX power, everything else with low TX power (rooftop repeater sorta deal)
-            repeat_full_pwr = p.rssi > -80
-            try:
-                time.sleep(0.1)
-                if repeat_full_pwr:
-                    _logger.debug("repeating this packet with full power")
-                    self.modem.set_tx_power(20)
-                self.modem.tx(p)
-            finally:
-                if repeat_full_pwr:
-                    self.modem.set_tx_power(0)
+            if heard:
+                self._cancel_repeat(packet)
+                return
+            if self._should_repeat(packet):
+                self._schedule_repeat(p, packet)
+        with self.modem.settings():
+            self.modem.set_preamble_length(16)
+            self.modem.set_syncword(0x12) # Meshcore (RADIOLIB_SX126X_SYNC_WORD_PRIVATE)
+            self.modem.set_aux_lora_settings(
+                crc=True,
+                invert_iq=False,
+                low_data_rate_optimize=False,
+            )
+        if self._own_scheduler:
+            self._scheduler.start()
         self.modem.start(rx_cb)
-        self.modem.set_preamble_length(16)
-        self.modem.set_syncword(0x12) # Meshcore (RADIOLIB_SX126X_SYNC_WORD_PRIVATE)
-        self.modem.set_aux_lora_settings(
-            crc=True,
-            invert_iq=False,
-            low_data_rate_optimize=False,
-        )
 
     def stop(self):
         self.modem.stop()
+        if self._own_scheduler:
+            self._scheduler.stop()
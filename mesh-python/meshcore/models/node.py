@@ -64,3 +64,9 @@ class MeshcoreNode(sillyorm.model.Model):
             **node_data,
         }
         return self.create(create_data)
+
+    def set_out_path(self, pubkey: bytes, out_path: list[int]):
+        found = self.search([("pubkey", "=", pubkey)])
+        if found and found.out_path != out_path:
+            found.write({"out_path": out_path})
+        return found
@@ -21,6 +21,10 @@ class ProtoMeshcore(sillyorm.model.Model):
     lora_bandwidth = sillyorm.fields.Integer(required=True)
     lora_coding_rate = sillyorm.fields.Integer(required=True)
 
+    # dedupe against every other proto_meshcore on this frequency sharing its cache, only makes sense for modems
+    # at the same site, elsewhere it would cost our own packet records and repeats
+    share_heard_cache = sillyorm.fields.Boolean(required=True, default=False)
+
     @sillyorm.model.constraints("lora_frequency", "lora_spreading_factor", "lora_bandwidth", "lora_coding_rate")
     def _check_lora(self):
         for record in self:
@@ -37,11 +41,17 @@ class ProtoMeshcore(sillyorm.model.Model):
         if "proto" not in data:
             data["queue"] = queue.SimpleQueue()
             modem = self.modem_id.get_instance()
-            modem.set_frequency(self.lora_frequency)
-            modem.set_spreading_factor(self.lora_spreading_factor)
-            modem.set_bandwidth(self.lora_bandwidth)
-            modem.set_coding_rate(self.lora_coding_rate)
-            data["proto"] = meshcore.Meshcore(modem, meshcore.MeshcoreNode({}), data["queue"])
+            with modem.settings():
+                modem.set_frequency(self.lora_frequency)
+                modem.set_spreading_factor(self.lora_spreading_factor)
+                modem.set_bandwidth(self.lora_bandwidth)
+                modem.set_coding_rate(self.lora_coding_rate)
+            data["proto"] = meshcore.Meshcore(
+                modem,
+                meshcore.MeshcoreNode({}),
+                data["queue"],
+                meshcore.shared_heard_cache(self.lora_frequency) if self.share_heard_cache else meshcore.HeardCache(),
+            )
         data["proto"].node.channels = {x.id: x.key for x in (self.channels if self.channels is not None else [])}
         data["proto"].start()
         while should_run_fn():
@@ -49,12 +59,17 @@ class ProtoMeshcore(sillyorm.model.Model):
                 time.sleep(0.1)
                 continue
             lora_packet, packet, heard = data["queue"].get()
-            if heard:
-                continue
             try:
+                # duplicates still count for routes, a later copy may have come along a shorter path
+                route_updates = data["proto"].learn_routes(packet)
+                if heard and not route_updates:
+                    continue
                 # we need to create a new env, as we want to ensure things will be committed
                 with orm.env_ctx() as env:
-                    env["meshcore_packet"].from_meshcore_packet(self.id, packet, lora_packet.snr, lora_packet.rssi)
+                    if not heard:
+                        env["meshcore_packet"].from_meshcore_packet(self.id, packet, lora_packet.snr, lora_packet.rssi)
+                    for pubkey, out_path in route_updates:
+                        env["meshcore_node"].set_out_path(pubkey, out_path)
             except:
                 _logger.exception("error creating meshcore_packet")
         data["proto"].stop()
@@ -1,7 +1,12 @@
 # Inspired from: https://gitlab.com/crankylinuxuser/meshtastic_sdr
 
+import concurrent.futures
+import dataclasses
 import logging
+import math
 import struct
+import threading
+import time
 import base64
 import cryptography.hazmat.primitives.ciphers
 import meshtastic
@@ -9,17 +14,231 @@ import json
 import random
 import uuid
 import google.protobuf.json_format
+import google.protobuf.message
 from . import lora_modem
+from .meshcore import meshcore
 
 
 _logger = logging.getLogger(__name__)
 
+# how long a packet is remembered as seen by the firmware
+# https://github.com/meshtastic/firmware/blob/57a3ff8dfcc7b2b4f766de224cc80376e7332564/src/mesh/PacketHistory.h#L6
+FLOOD_EXPIRE_TIME = 10 * 60
+
+_HEADER = struct.Struct("<IIIBBBB")
+_U128_MASK = (1 << 128) - 1
+_PORTNUM_UNKNOWN_APP = meshtastic.portnums_pb2.PortNum.UNKNOWN_APP
+
+_ROLE = meshtastic.config_pb2.Config.DeviceConfig.Role
+# roles relaying with the short contention window that don't step back when somebody else relayed first
+_ROLES_ROUTER = {_ROLE.ROUTER, _ROLE.ROUTER_CLIENT, _ROLE.REPEATER}
+
+# contention window, see RadioInterface.h/cpp in the firmware
+# https://github.com/meshtastic/firmware/blob/57a3ff8dfcc7b2b4f766de224cc80376e7332564/src/mesh/RadioInterface.cpp#L252-L303
+CW_MIN = 3
+CW_MAX = 8
+SNR_MIN = -20
+SNR_MAX = 10
+NUM_SYM_CAD = 2
+PROCESSING_TIME_MSEC = 0.2 + 0.4 + 7 # propagation, turnaround and MAC processing
+
+# protobuf in the Data payload per portnum
+_PORTNUM_PAYLOAD_CLASSES = {
+    meshtastic.portnums_pb2.PortNum.POSITION_APP: meshtastic.mesh_pb2.Position,
+    meshtastic.portnums_pb2.PortNum.NODEINFO_APP: meshtastic.mesh_pb2.NodeInfo,
+    meshtastic.portnums_pb2.PortNum.ROUTING_APP: meshtastic.mesh_pb2.Routing,
+    meshtastic.portnums_pb2.PortNum.TEXT_MESSAGE_COMPRESSED_APP: meshtastic.mesh_pb2.Compressed,
+    meshtastic.portnums_pb2.PortNum.WAYPOINT_APP: meshtastic.mesh_pb2.Waypoint,
+    meshtastic.portnums_pb2.PortNum.TELEMETRY_APP: meshtastic.telemetry_pb2.Telemetry,
+    meshtastic.portnums_pb2.PortNum.TRACEROUTE_APP: meshtastic.mesh_pb2.RouteDiscovery,
+    meshtastic.portnums_pb2.PortNum.NEIGHBORINFO_APP: meshtastic.mesh_pb2.NeighborInfo,
+}
+
+
+def packet_key(sender: int, packet_id: int) -> int:
+    """
+    key of a packet in the packet history, packet IDs are only unique per sender (both are 32 bit)
+    """
+    return (sender << 32) | packet_id
+
+
+class BloomPacketHistory:
+    """
+    Packet history with fixed memory use for very high packet rates, instead of a meshcore.HeardCache.
+    Two Bloom filters are used as generations, a new one is started every max_age_secs or after capacity
+    packets and lookups check both. So packets are remembered for at least max_age_secs (as long as less than
+    capacity arrive in that time) and at most twice that.
+    Unlike HeardCache this has false positives (at roughly fp_rate), those packets are not relayed.
+    """
+
+    def __init__(self, capacity: int = 65536, max_age_secs: float = FLOOD_EXPIRE_TIME, fp_rate: float = 0.001, clock=time.monotonic):
+        self.capacity = capacity
+        self.max_age_secs = max_age_secs
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._n_bits = max(8, int(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        self._n_hashes = max(1, round(self._n_bits / capacity * math.log(2)))
+        self._generations = [bytearray((self._n_bits + 7) // 8) for _ in range(2)] # current first
+        self._counts = [0, 0]
+        self._t_rotated = clock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "rotations": 0,
+        }
+
+    def __len__(self) -> int:
+        return sum(self._counts)
+
+    def __contains__(self, key: int) -> bool:
+        bits = self._bits(key)
+        with self._lock:
+            self._maybe_rotate(self._clock())
+            return any(self._test(g, bits) for g in self._generations)
+
+    def memory_bytes(self) -> int:
+        return sum(len(g) for g in self._generations)
+
+    def _bits(self, key: int) -> list[int]:
+        # double hashing with two 32 bit halves of a 64 bit mix (splitmix64 finalizer)
+        x = key & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        x ^= x >> 31
+        h1 = x & 0xFFFFFFFF
+        h2 = (x >> 32) | 1
+        return [(h1 + i * h2) % self._n_bits for i in range(self._n_hashes)]
+
+    @staticmethod
+    def _test(generation: bytearray, bits: list[int]) -> bool:
+        return all(generation[b >> 3] & (1 << (b & 7)) for b in bits)
+
+    def _maybe_rotate(self, now: float):
+        if now - self._t_rotated < self.max_age_secs and self._counts[0] < self.capacity:
+            return
+        self._generations = [bytearray(len(self._generations[0])), self._generations[0]]
+        self._counts = [0, self._counts[0]]
+        self._t_rotated = now
+        self.stats["rotations"] += 1
+
+    def check_and_add(self, key: int) -> bool:
+        """
+        returns True if the packet key (see packet_key) was (probably) seen before, otherwise remembers it and returns False
+        """
+        bits = self._bits(key)
+        with self._lock:
+            self._maybe_rotate(self._clock())
+            if any(self._test(g, bits) for g in self._generations):
+                self.stats["hits"] += 1
+                return True
+            self.stats["misses"] += 1
+            current = self._generations[0]
+            for b in bits:
+                current[b >> 3] |= 1 << (b & 7)
+            self._counts[0] += 1
+            return False
+
+
+class _ChannelCipher:
+    """
+    AES-CTR for a channel with the key set up once. CTR only needs the AES of successive counter blocks,
+    so one long lived ECB context generates the keystream for any nonce instead of building a cipher per packet.
+    """
+
+    def __init__(self, key: bytes):
+        self.key = key
+        self._lock = threading.Lock()
+        self._ecb = None
+        if key:
+            self._ecb = cryptography.hazmat.primitives.ciphers.Cipher(
+                cryptography.hazmat.primitives.ciphers.algorithms.AES(key),
+                cryptography.hazmat.primitives.ciphers.modes.ECB(),
+            ).encryptor()
+
+    def crypt_batch(self, items: list[tuple[bytes, bytes]]) -> list[bytes]:
+        """
+        en-/decrypt (CTR is symmetric) every (nonce, data), with one AES call for the whole batch
+        """
+        if self._ecb is None: # encryption disabled
+            return [bytes(data) for _, data in items]
+        blocks = []
+        for nonce, data in items:
+            # the counter is the whole block, incremented as a big endian integer
+            base = int.from_bytes(nonce, "big")
+            blocks.extend(((base + i) & _U128_MASK).to_bytes(16, "big") for i in range((len(data) + 15) // 16))
+        with self._lock:
+            keystream = self._ecb.update(b"".join(blocks))
+        out = []
+        offset = 0
+        for _, data in items:
+            n = len(data)
+            out.append((int.from_bytes(data, "little") ^ int.from_bytes(keystream[offset:offset+n], "little")).to_bytes(n, "little"))
+            offset += (n + 15) // 16 * 16
+        return out
+
+    def crypt(self, nonce: bytes, data: bytes) -> bytes:
+        return self.crypt_batch([(nonce, data)])[0]
+
+
+@dataclasses.dataclass(frozen=True)
+class _ChannelSet:
+    """
+    the configured channels, replaced as a whole so readers always see matching by_name and by_hash
+    """
+    by_name: dict # name -> channel dict
+    by_hash: dict # hash -> [channel dict], several channels can share a hash, all of them are tried when decoding
+
+
+@dataclasses.dataclass
+class _PendingRelay:
+    call: object # scheduler handle
+    tx_future: concurrent.futures.Future | None = None
+
 
 class Meshtastic:
-    def __init__(self, modem: lora_modem.LoraModem, channels: list[dict]):
+    """
+    Relays with the firmware's managed flooding: every relay waits for a contention window that gets longer
+    the better we heard the packet, so far away nodes relay first, and is cancelled if another node relays
+    the same packet meanwhile (except for router roles). CLIENT_MUTE never relays.
+    Relays are scheduled on scheduler (a meshcore.CallScheduler by default), RX never waits for them.
+    """
+
+    def __init__(
+        self,
+        modem: lora_modem.LoraModem,
+        channels: list[dict],
+        packet_history: meshcore.HeardCache | BloomPacketHistory | None = None,
+        role: int = _ROLE.CLIENT,
+        scheduler=None,
+        rng: random.Random | None = None,
+        received_msg_queue=None,
+    ):
         self._modem = modem
+        self._received_msg_queue = received_msg_queue
+        self.role = role
+        self._own_scheduler = scheduler is None
+        self._scheduler = scheduler if scheduler is not None else meshcore.CallScheduler()
+        self._rng = rng if rng is not None else random.Random()
+        self._relay_pending = {} # (sender, packetID) -> _PendingRelay
+        self._relay_pending_lock = threading.Lock()
+        self.relay_stats = {
+            "scheduled": 0,
+            "cancelled": 0,
+            "suppressed": 0,
+        }
+
+        self.set_channels(channels)
+        # like the firmware's PacketHistory, keyed on packet_key
+        self._packet_history = packet_history if packet_history is not None else meshcore.HeardCache(max_age_secs=FLOOD_EXPIRE_TIME)
+
+        self._node_id = int.from_bytes(random.Random(uuid.getnode()).randbytes(4), "little")
+        _logger.info("chose random node ID: %d (0x%x)", self._node_id, self._node_id)
 
-        self._channels = {
+    def set_channels(self, channels: list[dict]):
+        """
+        channels is a list of dicts with name and psk (base64), can be changed while running
+        """
+        by_name = {
             c["name"]: {
                 "hash": self._channel_hash(c2 := c | {
                     "key": self._psk_to_key(c["psk"]),
@@ -28,11 +247,15 @@ class Meshtastic:
             for c in channels
         }
 
-        self._channel_hash_map = {c["hash"]: c for c in self._channels.values()}
-        self._heard_packet_ids = set()
+        for c in by_name.values():
+            c["cipher"] = _ChannelCipher(c["key"])
 
-        self._node_id = int.from_bytes(random.Random(uuid.getnode()).randbytes(4), "little")
-        _logger.info("chose random node ID: %d (0x%x)", self._node_id, self._node_id)
+        by_hash = {}
+        for c in by_name.values():
+            by_hash.setdefault(c["hash"], []).append(c)
+
+        # a single assignment, RX and relays running meanwhile use either the old or the new set
+        self._channel_set = _ChannelSet(by_name, by_hash)
 
     def start(self):
         def rx_cb(p):
@@ -40,21 +263,21 @@ class Meshtastic:
                 self.packet_rx(p.data, p.rssi, p.snr)
             except:
                 _logger.exception("exception ingesting meshtastic packet")
+        # frequency, spreading factor, bandwidth and coding rate depend on the preset, set those before starting
+        with self._modem.settings():
+            self._modem.set_preamble_length(16)
+            self._modem.set_syncword(0x2b) # meshtastic
+            self._modem.set_aux_lora_settings(
+                crc=True,
+                invert_iq=False,
+                low_data_rate_optimize=False,
+            )
+        if self._own_scheduler:
+            self._scheduler.start()
         self._modem.start(rx_cb)
-        # LongFast EU_868
-        self._modem.set_frequency(869525000)
-        self._modem.set_spreading_factor(11)
-        self._modem.set_bandwidth(250000)
-        self._modem.set_coding_rate(5)
-        self._modem.set_preamble_length(16)
-        self._modem.set_syncword(0x2b) # meshtastic
-        self._modem.set_aux_lora_settings(
-            crc=True,
-            invert_iq=False,
-            low_data_rate_optimize=False,
-        )
 
     def _send_traceroute(self, to: int):
+        channel_set = self._channel_set
         payload = meshtastic.mesh_pb2.RouteDiscovery()
         msg = meshtastic.mesh_pb2.Data()
         msg.portnum = meshtastic.portnums_pb2.PortNum.TRACEROUTE_APP
@@ -68,7 +291,8 @@ class Meshtastic:
             "wantAck": True,
             "viaMQTT": False,
             "hopStart": 7,
-            "channelHash": self._channels["LongFast"]["hash"],
+            "channel": "LongFast",
+            "channelHash": channel_set.by_name["LongFast"]["hash"],
             "nextHop": 0,
             # "relayNode": self._node_id & 0xFF,
             "relayNode": 0,
@@ -76,97 +300,123 @@ class Meshtastic:
         }
         _logger.debug("npkdata: %s", npkdata)
         # make sure we don't relay our own packet again lmao
-        self._heard_packet_ids.add(npkdata["packetID"])
-        self._modem.tx(lora_modem.LoraPacket(self.packet_serialize(npkdata)))
+        self._packet_history.check_and_add(packet_key(npkdata["sender"], npkdata["packetID"]))
+        self._modem.tx(lora_modem.LoraPacket(self.packet_serialize(npkdata, channel_set)))
 
     def stop(self):
         self._modem.stop()
+        if self._own_scheduler:
+            self._scheduler.stop()
+
+    def _slot_time(self) -> float:
+        # time (s) for CAD plus turnaround, one slot of the contention window
+        params = self._modem.get_lora_params()
+        symbol_time_msec = (2 ** params["spreading_factor"]) / (params["bandwidth"] / 1000)
+        return (NUM_SYM_CAD * symbol_time_msec + PROCESSING_TIME_MSEC) / 1000
+
+    def _relay_delay(self, snr: float) -> float:
+        """
+        contention window delay like RadioInterface::getTxDelayMsecWeighted, better SNR = longer wait
+        """
+        cw_size = round(CW_MIN + (min(max(snr, SNR_MIN), SNR_MAX) - SNR_MIN) * (CW_MAX - CW_MIN) / (SNR_MAX - SNR_MIN))
+        slot_time = self._slot_time()
+        if self.role in _ROLES_ROUTER:
+            return self._rng.randrange(0, 2 * cw_size) * slot_time
+        # everyone else waits until the routers had their chance
+        return (2 * CW_MAX * slot_time) + self._rng.randrange(0, 2 ** cw_size) * slot_time
+
+    def _schedule_relay(self, packet: dict, npkdata: dict, channel_set: _ChannelSet):
+        key = (packet["sender"], packet["packetID"])
+        data = self.packet_serialize(npkdata, channel_set)
+        delay = self._relay_delay(packet["snr"])
+        _logger.debug("relaying packet %s in %fs", packet["packetID"], delay)
+        pending = _PendingRelay(None)
+        with self._relay_pending_lock:
+            self._relay_pending[key] = pending
+            self.relay_stats["scheduled"] += 1
+        pending.call = self._scheduler.call_later(delay, lambda: self._relay_due(key, pending, data))
+
+    def _relay_due(self, key: tuple[int, int], pending: _PendingRelay, data: bytes):
+        with self._relay_pending_lock:
+            if self._relay_pending.get(key) is not pending:
+                return
+        # outside the lock, tx can block on the modem
+        future = self._modem.tx(lora_modem.LoraPacket(data), lora_modem.TxPriority.REPEAT)
+        with self._relay_pending_lock:
+            pending.tx_future = future
+            cancelled = self._relay_pending.get(key) is not pending
+        if cancelled:
+            # heard somebody else relay it while handing it to the modem
+            future.cancel()
+        # might run right away if the future is already done, so not under the lock
+        future.add_done_callback(lambda _: self._relay_done(key, pending))
+
+    def _relay_done(self, key: tuple[int, int], pending: _PendingRelay):
+        with self._relay_pending_lock:
+            if self._relay_pending.get(key) is pending:
+                del self._relay_pending[key]
+
+    def _cancel_relay(self, packet: dict):
+        """
+        somebody else relayed this packet while we were waiting, our neighbours already have it
+        """
+        if self.role in _ROLES_ROUTER or self.role == _ROLE.ROUTER_LATE:
+            return
+        with self._relay_pending_lock:
+            pending = self._relay_pending.pop((packet["sender"], packet["packetID"]), None)
+            if pending is None:
+                return
+            pending.call.cancel()
+            if pending.tx_future is not None:
+                pending.tx_future.cancel()
+            self.relay_stats["cancelled"] += 1
+        _logger.debug("relay of %s cancelled, heard it from another node", packet["packetID"])
 
     def packet_rx(self, data: bytes, rssi: int, snr: float):
+        # the same channels for decrypting, relaying and replying, even if set_channels runs meanwhile
+        channel_set = self._channel_set
         packet = self.packet_deserialize(data, {
             "rssi": rssi,
             "snr": snr,
-        })
+        }, channel_set)
 
-        _logger.debug("received packet on channel '%s': %s", self._channel_hash_map.get(packet["channelHash"], {}).get("name"), repr(packet))
+        _logger.debug("received packet on channel '%s': %r", packet.get("channel"), packet)
 
-        if "payload" in packet:
-            protobuf_dict = google.protobuf.json_format.MessageToDict(packet["payload"], preserving_proto_field_name=True)
-            protobuf_dict_payload_bytes = base64.b64decode(protobuf_dict.get("payload", ""))
-            match protobuf_dict["portnum"]:
-                case "TEXT_MESSAGE_APP":
-                    protobuf_dict["payload"] = protobuf_dict_payload_bytes.decode("utf-8")
-            pb_lookup = {
-                "POSITION_APP": meshtastic.mesh_pb2.Position,
-                "NODEINFO_APP": meshtastic.mesh_pb2.NodeInfo,
-                "ROUTING_APP": meshtastic.mesh_pb2.Routing,
-                "TEXT_MESSAGE_COMPRESSED_APP": meshtastic.mesh_pb2.Compressed,
-                "WAYPOINT_APP": meshtastic.mesh_pb2.Waypoint,
-                "TELEMETRY_APP": meshtastic.telemetry_pb2.Telemetry,
-                "TRACEROUTE_APP": meshtastic.mesh_pb2.RouteDiscovery,
-                "NEIGHBORINFO_APP": meshtastic.mesh_pb2.NeighborInfo,
-            }
-            if protobuf_dict["portnum"] in pb_lookup:
-                pbd = pb_lookup[protobuf_dict["portnum"]]()
-                pbd.ParseFromString(protobuf_dict_payload_bytes)
-                protobuf_dict["payload"] = google.protobuf.json_format.MessageToDict(pbd, preserving_proto_field_name=True)
+        if "payload" in packet and _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug("packet decoded protobuf: %s", self._data_to_dict(packet["payload"]))
 
-            _logger.debug("packet decoded protobuf: %s", protobuf_dict)
+        seen = self._packet_history.check_and_add(packet_key(packet["sender"], packet["packetID"]))
+        if self._received_msg_queue is not None:
+            self._received_msg_queue.put((packet, seen))
 
         # relay?
-        if packet["hopLimit"] > 0 and packet["packetID"] not in self._heard_packet_ids and packet["destination"] != self._node_id:
-            # TODO: meshtastic actually has intelligent algos for this, if
-            # this code was deployed on every node the network would be ass lmao
-            # _fix it_
-            npkdata = dict(packet)
-            npkdata["hopLimit"] -= 1
-            _logger.debug("relaying packet: %s", npkdata["packetID"])
-            self._heard_packet_ids.add(packet["packetID"])
-            # traceroute to someone else?
-            if "payload" in packet and protobuf_dict["portnum"] == "TRACEROUTE_APP":
-                _logger.debug("processing traceroute")
-                # FIXME: traceroute seems to use nextHop on the way back.. we just ignore that lmfao.. we should probably not (https://github.com/meshtastic/firmware/blob/57a3ff8dfcc7b2b4f766de224cc80376e7332564/src/modules/TraceRouteModule.cpp#L269)
-                new_pb_payload = protobuf_dict["payload"]
-
-                # figure out direction and which values to set
-                is_on_way_back = "request_id" in protobuf_dict
-                hops_away = packet["hopStart"] - packet["hopLimit"]
-                route_key = "route" if not is_on_way_back else "route_back"
-                snr_key = "snr_towards" if not is_on_way_back else "snr_back"
-                # ensure snr and route arrays exist
-                for k in [route_key, snr_key]:
-                    if k not in new_pb_payload:
-                        new_pb_payload[k] = []
-
-                # fix the route (there may have been unknown hops)
-                if hops_away >= 0:
-                    diff = hops_away - len(new_pb_payload[route_key])
-                    for _ in range(diff):
-                        new_pb_payload[route_key].append(0xFFFFFFFF) # broadcast = unknown node
-                    diff = hops_away - len(new_pb_payload[snr_key])
-                    for _ in range(diff):
-                        new_pb_payload[snr_key].append(-128) # minimum value of 8-bit signed (two's complement) integer = unknown node
-                
-                # add the current hop to the route
-                new_pb_payload[snr_key].append(int(snr * 4)) # SNR is converted to a byte by multiplying to by 4
-                new_pb_payload[route_key].append(self._node_id)
-
-                _logger.debug("processed traceroute: %s", new_pb_payload)
-
-                npkdata["payload"].payload = google.protobuf.json_format.ParseDict(new_pb_payload, meshtastic.mesh_pb2.RouteDiscovery(), ignore_unknown_fields=False).SerializeToString()
-            self._modem.tx(lora_modem.LoraPacket(self.packet_serialize(npkdata)))
-        else:
-            self._heard_packet_ids.add(packet["packetID"])
+        if seen:
+            self._cancel_relay(packet)
+        elif packet["hopLimit"] > 0 and packet["destination"] != self._node_id:
+            if self.role == _ROLE.CLIENT_MUTE:
+                self.relay_stats["suppressed"] += 1
+            else:
+                npkdata = dict(packet)
+                npkdata["hopLimit"] -= 1
+                # traceroute to someone else?
+                if "payload" in packet and packet["payload"].portnum == meshtastic.portnums_pb2.PortNum.TRACEROUTE_APP:
+                    npkdata["payload"] = self._traceroute_add_hop(packet)
+                    del npkdata["payload_decrypted"]
+                else:
+                    # nothing changes in the payload, send the received ciphertext again as is
+                    npkdata.pop("payload", None)
+                    npkdata.pop("payload_decrypted", None)
+                self._schedule_relay(packet, npkdata, channel_set)
 
         if "payload" not in packet:
             _logger.debug("no payload in packet, cannot process further")
             return
 
         # TODO: traceroute to us?
-        # if protobuf_dict["portnum"] == "TRACEROUTE_APP" and packet["destination"] == self._node_id:
+        # if packet["payload"].portnum == meshtastic.portnums_pb2.PortNum.TRACEROUTE_APP and packet["destination"] == self._node_id:
 
         # ping reply?
-        if packet["payload"].portnum == meshtastic.portnums_pb2.PortNum.TEXT_MESSAGE_APP and packet["channelHash"] == self._channels["gg"]["hash"] and packet["payload"].payload.decode("utf-8", errors="ignore").startswith("ping"):
+        if packet["payload"].portnum == meshtastic.portnums_pb2.PortNum.TEXT_MESSAGE_APP and packet.get("channel") == "gg" and packet["payload"].payload.decode("utf-8", errors="ignore").startswith("ping"):
             msg = meshtastic.mesh_pb2.Data()
             msg.portnum = meshtastic.portnums_pb2.PortNum.TEXT_MESSAGE_APP
             msg.payload = f"pong RSSI: {rssi}dBm SNR: {snr}dB".encode("utf-8")
@@ -180,24 +430,81 @@ class Meshtastic:
                 "wantAck": False,
                 "viaMQTT": False,
                 "hopStart": 3,
-                "channelHash": self._channels["gg"]["hash"],
+                "channel": "gg",
+                "channelHash": channel_set.by_name["gg"]["hash"],
                 "nextHop": 0,
                 "relayNode": 0,
                 "payload": msg,
             }
             # make sure we don't relay our own packet again lmao
-            self._heard_packet_ids.add(npkdata["packetID"])
+            self._packet_history.check_and_add(packet_key(npkdata["sender"], npkdata["packetID"]))
+
+            self._modem.tx(lora_modem.LoraPacket(self.packet_serialize(npkdata, channel_set)))
+
+    def _traceroute_add_hop(self, packet: dict):
+        """
+        copy of the Data of a traceroute we relay, with us added to the route
+        """
+        _logger.debug("processing traceroute")
+        # FIXME: traceroute seems to use nextHop on the way back.. we just ignore that lmfao.. we should probably not (https://github.com/meshtastic/firmware/blob/57a3ff8dfcc7b2b4f766de224cc80376e7332564/src/modules/TraceRouteModule.cpp#L269)
+        route_discovery = meshtastic.mesh_pb2.RouteDiscovery.FromString(packet["payload"].payload)
+
+        # figure out direction and which values to set
+        is_on_way_back = packet["payload"].request_id != 0
+        hops_away = packet["hopStart"] - packet["hopLimit"]
+        route = route_discovery.route if not is_on_way_back else route_discovery.route_back
+        snrs = route_discovery.snr_towards if not is_on_way_back else route_discovery.snr_back
+
+        # fix the route (there may have been unknown hops)
+        if hops_away >= 0:
+            route.extend([0xFFFFFFFF] * (hops_away - len(route))) # broadcast = unknown node
+            snrs.extend([-128] * (hops_away - len(snrs))) # minimum value of 8-bit signed (two's complement) integer = unknown node
+
+        # add the current hop to the route
+        snrs.append(int(packet["snr"] * 4)) # SNR is converted to a byte by multiplying to by 4
+        route.append(self._node_id)
 
-            self._modem.tx(lora_modem.LoraPacket(self.packet_serialize(npkdata)))
+        _logger.debug("processed traceroute: %s", route_discovery)
+
+        data = meshtastic.mesh_pb2.Data()
+        data.CopyFrom(packet["payload"])
+        data.payload = route_discovery.SerializeToString()
+        return data
+
+    @staticmethod
+    def decode_inner_payload(data):
+        """
+        the payload of a Data message decoded according to its portnum: str for text messages, a protobuf message
+        for known ports, otherwise the raw bytes. Only done when something needs it, relaying doesn't.
+        """
+        if data.portnum == meshtastic.portnums_pb2.PortNum.TEXT_MESSAGE_APP:
+            return data.payload.decode("utf-8")
+        pb_class = _PORTNUM_PAYLOAD_CLASSES.get(data.portnum)
+        if pb_class is None:
+            return data.payload
+        return pb_class.FromString(data.payload)
+
+    @classmethod
+    def _data_to_dict(cls, data) -> dict:
+        # for logging only
+        protobuf_dict = google.protobuf.json_format.MessageToDict(data, preserving_proto_field_name=True)
+        try:
+            payload = cls.decode_inner_payload(data)
+        except:
+            return protobuf_dict
+        if isinstance(payload, google.protobuf.message.Message):
+            payload = google.protobuf.json_format.MessageToDict(payload, preserving_proto_field_name=True)
+        if not isinstance(payload, bytes):
+            protobuf_dict["payload"] = payload
+        return protobuf_dict
+
+    def packet_serialize(self, packet: dict, channel_set: _ChannelSet | None = None) -> bytes:
+        if channel_set is None:
+            channel_set = self._channel_set
 
-    def packet_serialize(self, packet: dict) -> bytes:
         def packet_encrypt(packet: dict):
-            cipher = self._packet_prepare_cipher(packet)
-            if not cipher:  # unencrypted
-                return packet["payload_decrypted"]
-            encryptor = cipher.encryptor()
-            encrypted = encryptor.update(packet["payload_decrypted"]) + encryptor.finalize()
-            return encrypted
+            channel = self._packet_channel(packet, channel_set)
+            return channel["cipher"].crypt(self._packet_nonce(packet), packet["payload_decrypted"])
 
         # if the packet has a payload, we must serialize it
         if "payload" in packet:
@@ -208,8 +515,6 @@ class Meshtastic:
             packet["payload_encrypted"] = packet_encrypt(packet)
 
         # https://meshtastic.org/docs/overview/mesh-algo/
-        HEADER_STRUCT = "<IIIBBBB"
-
         flags = (
             (packet["hopLimit"] & 0x7) | 
             (int(packet["wantAck"]) << 3) |
@@ -217,8 +522,7 @@ class Meshtastic:
             ((packet["hopStart"] & 0x7) << 5)
         )
 
-        header = struct.pack(
-            HEADER_STRUCT,
+        header = _HEADER.pack(
             packet["destination"],
             packet["sender"],
             packet["packetID"],
@@ -230,70 +534,104 @@ class Meshtastic:
 
         return header + packet["payload_encrypted"]
 
-    def packet_deserialize(self, data: bytes, extra_data: dict) -> bytes:
-        def packet_decrypt(packet: dict):
-            cipher = self._packet_prepare_cipher(packet)
-            if not cipher:  # unencrypted
-                return packet["payload_encrypted"]
-            decryptor = cipher.decryptor()
-            decrypted = decryptor.update(packet["payload_encrypted"]) + decryptor.finalize()
-            return decrypted
-
-        # deserialize
-        # https://meshtastic.org/docs/overview/mesh-algo/
-        HEADER_STRUCT = "<IIIBBBB"
-        dest, sender, pid, flags, chsh, nxhop, rlnode = struct.unpack_from(HEADER_STRUCT, data)
-        payload = data[struct.calcsize(HEADER_STRUCT):]
-        packet = {
-            "destination": dest,
-            "sender": sender,
-            "packetID": pid,
-            "hopLimit": flags & 0x7,
-            "wantAck": bool((flags >> 3) & 0x1),
-            "viaMQTT": bool((flags >> 4) & 0x1),
-            "hopStart": (flags >> 5) & 0x7,
-            "channelHash": chsh,
-            "nextHop": nxhop,
-            "relayNode": rlnode,
-            "payload_encrypted": payload,
-        }
-
-        packet = packet | extra_data
-
-        try:
-            payload_decrypted = packet_decrypt(packet)
-            if payload_decrypted:
+    def packet_deserialize(self, data: bytes, extra_data: dict, channel_set: _ChannelSet | None = None) -> dict:
+        return self.packets_deserialize([(data, extra_data)], channel_set)[0]
+
+    def packets_deserialize(self, items: list[tuple[bytes, dict]], channel_set: _ChannelSet | None = None) -> list[dict]:
+        """
+        Deserialize and decrypt many (data, extra_data) at once, every channel does one AES call for the batch.
+        Packets whose channel hash matches several channels are decrypted with each candidate, the first one
+        giving a valid Data protobuf wins (like the firmware in Router::perhapsDecode).
+        """
+        if channel_set is None:
+            channel_set = self._channel_set
+        channel_hash_map = channel_set.by_hash
+        packets = []
+        batches = {} # channel name -> (channel, [(packet index, nonce, ciphertext)])
+        for data, extra_data in items:
+            # https://meshtastic.org/docs/overview/mesh-algo/
+            dest, sender, pid, flags, chsh, nxhop, rlnode = _HEADER.unpack_from(data)
+            packet = {
+                "destination": dest,
+                "sender": sender,
+                "packetID": pid,
+                "hopLimit": flags & 0x7,
+                "wantAck": bool((flags >> 3) & 0x1),
+                "viaMQTT": bool((flags >> 4) & 0x1),
+                "hopStart": (flags >> 5) & 0x7,
+                "channelHash": chsh,
+                "nextHop": nxhop,
+                "relayNode": rlnode,
+                "payload_encrypted": bytes(data[_HEADER.size:]),
+            } | extra_data
+            candidates = channel_hash_map.get(chsh, [])
+            if not candidates:
+                _logger.debug("no channel for hash 0x%x", chsh)
+            nonce = self._packet_nonce(packet)
+            for channel in candidates:
+                batches.setdefault(channel["name"], (channel, []))[1].append((len(packets), nonce, packet["payload_encrypted"]))
+            packets.append(packet)
+
+        decrypted = {} # (packet index, channel name) -> plaintext
+        for name, (channel, batch) in batches.items():
+            try:
+                plaintexts = channel["cipher"].crypt_batch([(nonce, ct) for _, nonce, ct in batch])
+            except:
+                _logger.exception("exception decrypting packets")
+                continue
+            for (i, _, _), plaintext in zip(batch, plaintexts):
+                decrypted[(i, name)] = plaintext
+
+        for i, packet in enumerate(packets):
+            for channel in channel_hash_map.get(packet["channelHash"], []):
+                payload_decrypted = decrypted.get((i, channel["name"]))
+                if not payload_decrypted:
+                    continue
+                pdata = self._parse_data(payload_decrypted)
+                if pdata is None:
+                    continue
+                packet["channel"] = channel["name"]
                 packet["payload_decrypted"] = payload_decrypted
-                pdata = meshtastic.mesh_pb2.Data()
-                pdata.ParseFromString(packet["payload_decrypted"])
                 packet["payload"] = pdata
+                break
             else:
-                _logger.debug("could not decrypt packet:", packet)
-        except:
-            _logger.exception("exception decrypting packet")
+                _logger.debug("could not decrypt packet: %s", packet)
 
-        return packet
-
-    def _packet_prepare_cipher(self, packet: dict):
-        channel = self._channel_hash_map.get(packet["channelHash"])
-        if not channel:
-            raise Exception("no channel for cipher found")
-        key = channel["key"]
+        return packets
 
-        if len(key) == 0: # encryption disabled
+    @staticmethod
+    def _parse_data(data: bytes):
+        """
+        the Data protobuf if data is one, used to tell whether the right key was used
+        """
+        pdata = meshtastic.mesh_pb2.Data()
+        try:
+            pdata.ParseFromString(data)
+        except google.protobuf.message.DecodeError:
+            return None
+        if pdata.portnum == _PORTNUM_UNKNOWN_APP:
             return None
+        return pdata
 
+    @staticmethod
+    def _packet_channel(packet: dict, channel_set: _ChannelSet) -> dict:
+        if "channel" in packet:
+            channel = channel_set.by_name.get(packet["channel"])
+            if channel is None:
+                raise Exception(f"channel {packet['channel']} is not configured")
+            return channel
+        candidates = channel_set.by_hash.get(packet["channelHash"])
+        if not candidates:
+            raise Exception("no channel for cipher found")
+        return candidates[0]
+
+    @staticmethod
+    def _packet_nonce(packet: dict) -> bytes:
         # the nonce is the packet ID, zeros, then the sender node ID and then zeros again
-        nonce = (
+        return (
             packet["packetID"] | (packet["sender"] << 64)
         ).to_bytes(16, "little")
 
-        cipher = cryptography.hazmat.primitives.ciphers.Cipher(
-            cryptography.hazmat.primitives.ciphers.algorithms.AES(key),
-            cryptography.hazmat.primitives.ciphers.modes.CTR(nonce),
-        )
-        return cipher
-
     @staticmethod
     def _channel_hash(channel: dict) -> int:
         # https://github.com/meshtastic/firmware/blob/6f7149e9a2e54fcb85cfe14cfd2d1db1b25a05b0/src/mesh/Channels.cpp#L33-L50
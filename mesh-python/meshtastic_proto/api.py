@@ -0,0 +1,13 @@
+import logging
+from .. import orm
+from . import models
+from . import routes
+
+
+_logger = logging.getLogger(__name__)
+
+
+def startup():
+    with orm.env_ctx() as env:
+        for p in env["proto_meshtastic"].search([("enabled", "=", True)]):
+            p.start()
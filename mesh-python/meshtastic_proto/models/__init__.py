@@ -0,0 +1 @@
+from . import proto, packet, channel
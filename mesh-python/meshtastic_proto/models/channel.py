@@ -0,0 +1,30 @@
+import logging
+import base64
+import sillyorm
+from ... import orm
+
+_logger = logging.getLogger(__name__)
+
+@orm.register_model
+class MeshtasticChannel(sillyorm.model.Model):
+    _name = "meshtastic_channel"
+
+    name = sillyorm.fields.String(required=True)
+    # as in the channel settings, one byte PSKs select the default key (and 0 turns encryption off)
+    psk = sillyorm.fields.LargeBinary(required=True)
+
+    @sillyorm.model.constraints("psk")
+    def _check_psk(self):
+        for record in self:
+            if len(record.psk) < 1 or len(record.psk) > 32:
+                raise Exception("PSKs must be 1 to 32 bytes")
+
+    def get_channel_dict(self) -> dict:
+        """
+        the channel as passed to meshtastic_dm.Meshtastic
+        """
+        self.ensure_one()
+        return {
+            "name": self.name,
+            "psk": base64.b64encode(self.psk).decode(),
+        }
@@ -0,0 +1,83 @@
+import logging
+import datetime
+import sillyorm
+from ... import orm
+
+_logger = logging.getLogger(__name__)
+
+
+@orm.register_model
+class MeshtasticPacket(sillyorm.model.Model):
+    _name = "meshtastic_packet"
+
+    proto_id = sillyorm.fields.Many2one("proto_meshtastic", required=True)
+
+    snr = sillyorm.fields.Float()
+    rssi = sillyorm.fields.Integer()
+    outgoing = sillyorm.fields.Boolean(required=True)
+
+    timestamp_received = sillyorm.fields.Datetime(tzinfo=datetime.timezone.utc, convert_tz=True, required=True)
+
+    # header
+    destination = sillyorm.fields.Integer(required=True)
+    sender = sillyorm.fields.Integer(required=True)
+    packet_id = sillyorm.fields.Integer(required=True)
+    hop_limit = sillyorm.fields.Integer(required=True)
+    hop_start = sillyorm.fields.Integer(required=True)
+    want_ack = sillyorm.fields.Boolean(required=True)
+    via_mqtt = sillyorm.fields.Boolean(required=True)
+    channel_hash = sillyorm.fields.Integer(required=True)
+    next_hop = sillyorm.fields.Integer(required=True)
+    relay_node = sillyorm.fields.Integer(required=True)
+
+    # set if we could decrypt it, otherwise only payload_encrypted is
+    channel_id = sillyorm.fields.Many2one("meshtastic_channel")
+    portnum = sillyorm.fields.Integer()
+    payload = sillyorm.fields.LargeBinary()
+    payload_encrypted = sillyorm.fields.LargeBinary(required=True)
+
+    @sillyorm.model.constraints("outgoing")
+    def _check_outgoing(self):
+        for record in self:
+            has_snr = record.snr is not None
+            has_rssi = record.rssi is not None
+            if record.outgoing:
+                if has_snr or has_rssi:
+                    raise Exception("outgoing packets cannot have SNR or RSSI")
+            else:
+                if not has_snr or not has_rssi:
+                    raise Exception("incoming packets must have SNR or RSSI")
+
+    def _get_vals(self, proto_id, packet: dict, timestamp_received: datetime.datetime, channel_ids: dict) -> dict:
+        vals = {
+            "proto_id": proto_id,
+            "snr": packet["snr"],
+            "rssi": packet["rssi"],
+            "outgoing": False,
+            "timestamp_received": timestamp_received,
+            "destination": packet["destination"],
+            "sender": packet["sender"],
+            "packet_id": packet["packetID"],
+            "hop_limit": packet["hopLimit"],
+            "hop_start": packet["hopStart"],
+            "want_ack": packet["wantAck"],
+            "via_mqtt": packet["viaMQTT"],
+            "channel_hash": packet["channelHash"],
+            "next_hop": packet["nextHop"],
+            "relay_node": packet["relayNode"],
+            "channel_id": channel_ids.get(packet.get("channel")),
+            "portnum": None,
+            "payload": None,
+            "payload_encrypted": packet["payload_encrypted"],
+        }
+        if "payload" in packet:
+            vals["portnum"] = packet["payload"].portnum
+            vals["payload"] = packet["payload"].payload
+        return vals
+
+    def from_meshtastic_packets(self, proto_id, packets: list[tuple[dict, datetime.datetime]], channel_ids: dict):
+        """
+        store received packets (as returned by Meshtastic.packet_deserialize, with the time they were received),
+        all in the current transaction. channel_ids maps channel names to meshtastic_channel IDs.
+        """
+        return [self.create(self._get_vals(proto_id, packet, timestamp_received, channel_ids)) for packet, timestamp_received in packets]
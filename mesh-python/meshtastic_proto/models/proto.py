@@ -0,0 +1,91 @@
+import logging
+import time
+import datetime
+import queue
+import sillyorm
+import meshtastic
+from ... import orm
+from ... import meshtastic_dm
+
+
+_logger = logging.getLogger(__name__)
+
+# received packets are written in batches of up to this many, or whatever arrived within this time
+BATCH_MAX_PACKETS = 100
+BATCH_MAX_SECS = 1.0
+
+
+@orm.register_model
+class ProtoMeshtastic(sillyorm.model.Model):
+    _name = "proto_meshtastic"
+    _inherits = ["proto_common"]
+
+    channels = sillyorm.fields.Many2many("meshtastic_channel")
+
+    lora_frequency = sillyorm.fields.Integer(required=True)
+    lora_spreading_factor = sillyorm.fields.Integer(required=True)
+    lora_bandwidth = sillyorm.fields.Integer(required=True)
+    lora_coding_rate = sillyorm.fields.Integer(required=True)
+
+    role = sillyorm.fields.Selection(["client", "client_mute", "router", "repeater", "router_late"], required=True, default="client")
+
+    @sillyorm.model.constraints("lora_frequency", "lora_spreading_factor", "lora_bandwidth", "lora_coding_rate")
+    def _check_lora(self):
+        for record in self:
+            if record.lora_frequency <= 0:
+                raise Exception("invalid lora frequency")
+            if record.lora_spreading_factor not in [5 + x for x in range(7)]:
+                raise Exception("invalid lora spreading factor")
+            if record.lora_bandwidth <= 0 or record.lora_bandwidth > 500000:
+                raise Exception("invalid lora bandwidth")
+            if record.lora_coding_rate < 5 or record.lora_coding_rate > 8:
+                raise Exception("invalid lora coding rate")
+
+    def _next_batch(self, should_run_fn, q: queue.SimpleQueue) -> list:
+        batch = []
+        t_first = None
+        while len(batch) < BATCH_MAX_PACKETS and should_run_fn():
+            timeout = 0.1 if t_first is None else t_first + BATCH_MAX_SECS - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                packet, seen = q.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if seen:
+                continue
+            if t_first is None:
+                t_first = time.monotonic()
+            batch.append((packet, datetime.datetime.now(datetime.timezone.utc)))
+        return batch
+
+    def _run(self, should_run_fn, data):
+        channels = self.channels if self.channels is not None else []
+        if "proto" not in data:
+            data["queue"] = queue.SimpleQueue()
+            modem = self.modem_id.get_instance()
+            with modem.settings():
+                modem.set_frequency(self.lora_frequency)
+                modem.set_spreading_factor(self.lora_spreading_factor)
+                modem.set_bandwidth(self.lora_bandwidth)
+                modem.set_coding_rate(self.lora_coding_rate)
+            data["proto"] = meshtastic_dm.Meshtastic(
+                modem,
+                [],
+                role=meshtastic.config_pb2.Config.DeviceConfig.Role.Value(self.role.upper()),
+                received_msg_queue=data["queue"],
+            )
+        data["proto"].set_channels([x.get_channel_dict() for x in channels])
+        channel_ids = {x.name: x.id for x in channels}
+        data["proto"].start()
+        while should_run_fn():
+            batch = self._next_batch(should_run_fn, data["queue"])
+            if not batch:
+                continue
+            try:
+                # one transaction per batch instead of per packet
+                with orm.env_ctx() as env:
+                    env["meshtastic_packet"].from_meshtastic_packets(self.id, batch, channel_ids)
+            except:
+                _logger.exception("error creating %d meshtastic_packet", len(batch))
+        data["proto"].stop()
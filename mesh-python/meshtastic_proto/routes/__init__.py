@@ -0,0 +1,2 @@
+from . import router
+from . import channels, packets
@@ -0,0 +1,38 @@
+from typing import Annotated
+import base64
+import fastapi
+import sillyorm
+from ... import orm
+from .router import router
+from . import pydantic_models
+
+
+@router.get("/channels")
+async def channel_list(env: Annotated[sillyorm.Environment, fastapi.Depends(orm.env)]) -> list[pydantic_models.MeshtasticChannelPydanticWithId]:
+    channels = env["meshtastic_channel"].search([])
+    return [pydantic_models.MeshtasticChannelPydanticWithId(name=c.name, psk=base64.b64encode(c.psk), id=c.id) for c in channels]
+
+
+@router.post("/channels")
+async def channel_create(env: Annotated[sillyorm.Environment, fastapi.Depends(orm.env)], channel: pydantic_models.MeshtasticChannelPydantic) -> int:
+    channel_id = env["meshtastic_channel"].create({"name": channel.name, "psk": channel.psk}).id
+    return channel_id
+
+
+@router.get("/channels/{channel_id}")
+async def channel_get(env: Annotated[sillyorm.Environment, fastapi.Depends(orm.env)], channel_id: int):
+    channel = env["meshtastic_channel"].browse(channel_id)
+    return pydantic_models.MeshtasticChannelPydantic(name=channel.name, psk=base64.b64encode(channel.psk))
+
+
+@router.put("/channels/{channel_id}")
+async def channel_update(env: Annotated[sillyorm.Environment, fastapi.Depends(orm.env)], channel_id: int, channel: pydantic_models.MeshtasticChannelPydantic):
+    env["meshtastic_channel"].browse(channel_id).write({
+        "name": channel.name,
+        "psk": channel.psk,
+    })
+
+
+@router.delete("/channels/{channel_id}")
+async def channel_delete(env: Annotated[sillyorm.Environment, fastapi.Depends(orm.env)], channel_id: int):
+    env["meshtastic_channel"].browse(channel_id).delete()
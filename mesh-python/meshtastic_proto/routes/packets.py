@@ -0,0 +1,23 @@
+from typing import Annotated
+import fastapi
+import sillyorm
+from ... import orm
+from .router import router
+from . import pydantic_models
+
+
+@router.get("/packets")
+async def packet_list(env: Annotated[sillyorm.Environment, fastapi.Depends(orm.env)], proto_id: int | None = None, limit: int = 100, offset: int = 0) -> list[pydantic_models.MeshtasticPacketPydanticWithId]:
+    if limit > 1000:
+        raise Exception("you may request at most 1000 packets per request")
+    domain = []
+    if proto_id is not None:
+        domain.append(("proto_id", "=", proto_id))
+    packets = env["meshtastic_packet"].search(domain, limit=limit, offset=offset)
+    return [pydantic_models.MeshtasticPacketPydanticWithId.from_record(record) for record in packets]
+
+
+@router.get("/packets/{packet_id}")
+async def packet_get(env: Annotated[sillyorm.Environment, fastapi.Depends(orm.env)], packet_id: int):
+    packet = env["meshtastic_packet"].browse(packet_id)
+    return pydantic_models.MeshtasticPacketPydanticWithId.from_record(packet)
@@ -0,0 +1,63 @@
+import base64
+import datetime
+import pydantic
+
+
+class MeshtasticChannelPydantic(pydantic.BaseModel):
+    name: str
+    psk: pydantic.Base64Bytes
+
+
+class MeshtasticChannelPydanticWithId(MeshtasticChannelPydantic):
+    id: int
+
+
+class MeshtasticPacketPydantic(pydantic.BaseModel):
+    proto_id: int
+    snr: float | None
+    rssi: int | None
+    outgoing: bool
+    timestamp_received: datetime.datetime
+    destination: int
+    sender: int
+    packet_id: int
+    hop_limit: int
+    hop_start: int
+    want_ack: bool
+    via_mqtt: bool
+    channel_hash: int
+    next_hop: int
+    relay_node: int
+    channel_id: int | None
+    portnum: int | None
+    payload: pydantic.Base64Bytes | None
+    payload_encrypted: pydantic.Base64Bytes
+
+
+class MeshtasticPacketPydanticWithId(MeshtasticPacketPydantic):
+    id: int
+
+    @staticmethod
+    def from_record(record):
+        return MeshtasticPacketPydanticWithId(
+            proto_id=record.proto_id.id,
+            snr=record.snr,
+            rssi=record.rssi,
+            outgoing=record.outgoing,
+            timestamp_received=record.timestamp_received,
+            destination=record.destination,
+            sender=record.sender,
+            packet_id=record.packet_id,
+            hop_limit=record.hop_limit,
+            hop_start=record.hop_start,
+            want_ack=record.want_ack,
+            via_mqtt=record.via_mqtt,
+            channel_hash=record.channel_hash,
+            next_hop=record.next_hop,
+            relay_node=record.relay_node,
+            channel_id=record.channel_id.id if record.channel_id else None,
+            portnum=record.portnum,
+            payload=base64.b64encode(record.payload) if record.payload is not None else None,
+            payload_encrypted=base64.b64encode(record.payload_encrypted),
+            id=record.id,
+        )
@@ -0,0 +1,308 @@
+import dataclasses
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from . import lora_modem
+
+_logger = logging.getLogger(__name__)
+
+# a frame survives a collision if it is at least this much stronger than every interferer
+CAPTURE_THRESHOLD_DB = 6
+
+
+def demod_snr_limit(spreading_factor: int) -> float:
+    """
+    lowest SNR (dB) a frame with the given spreading factor can still be demodulated at (SX127x/SX126x datasheets)
+    """
+    return -7.5 - 2.5 * (spreading_factor - 7)
+
+
+@dataclasses.dataclass
+class VirtualLink:
+    rssi: int # RSSI (dBm)
+    snr: float # SNR (dB)
+
+
+class _TimerHandle:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+@dataclasses.dataclass
+class _Transmission:
+    sender: "VirtualLoraModem"
+    data: bytes
+    frequency: int
+    spreading_factor: int
+    t_start: float
+    t_end: float
+
+
+class VirtualAir:
+    """
+    In-process RF medium shared by many VirtualLoraModem instances.
+
+    Frames are on the air for their calculated airtime. A receiver gets a frame when it is listening with
+    matching settings, has a link to the sender, the link SNR is above the demodulation limit, it wasn't
+    transmitting itself and no overlapping frame on the same frequency/SF was too strong at the receiver.
+
+    With simulated=True time only advances through run()/run_until(), rx callbacks are called from the
+    thread calling those and everything is deterministic for a given seed.
+    With simulated=False the air runs in its own thread in real time, use start()/stop().
+    """
+
+    def __init__(self, simulated: bool = True, seed: int = 0, default_link: VirtualLink | None = None, snr_jitter: float = 0.0):
+        self._simulated = simulated
+        self._rng = random.Random(seed)
+        self._default_link = default_link
+        self._snr_jitter = snr_jitter
+        self._links = {}
+        self._nodes = []
+        self._transmissions = []
+        self._events = []
+        self._event_seq = itertools.count()
+        self._t_sim = 0.0
+        self._t0 = time.monotonic()
+        self._cond = threading.Condition(threading.RLock())
+        self._thread = None
+        self._thread_stop = False
+        self.stats = {
+            "transmitted": 0,
+            "received": 0,
+            "collisions": 0,
+            "weak": 0,
+        }
+
+    def now(self) -> float:
+        if self._simulated:
+            return self._t_sim
+        return time.monotonic() - self._t0
+
+    def set_link(self, a: "VirtualLoraModem", b: "VirtualLoraModem", rssi: int, snr: float, symmetric: bool = True) -> None:
+        with self._cond:
+            self._links[(a, b)] = VirtualLink(rssi, snr)
+            if symmetric:
+                self._links[(b, a)] = VirtualLink(rssi, snr)
+
+    def _get_link(self, sender, receiver) -> VirtualLink | None:
+        return self._links.get((sender, receiver), self._default_link)
+
+    def _add_node(self, node: "VirtualLoraModem") -> None:
+        with self._cond:
+            self._nodes.append(node)
+
+    def _schedule(self, t: float, fn) -> None:
+        with self._cond:
+            heapq.heappush(self._events, (t, next(self._event_seq), fn))
+            self._cond.notify_all()
+
+    def call_later(self, delay: float, fn) -> _TimerHandle:
+        """
+        call fn after delay seconds of air time (e.g. as meshcore.Meshcore scheduler), cancel() the handle to skip it
+        """
+        handle = _TimerHandle()
+
+        def _event():
+            if not handle.cancelled:
+                fn()
+            return []
+
+        self._schedule(self.now() + delay, _event)
+        return handle
+
+    def transmit(self, sender: "VirtualLoraModem", data: bytes, airtime: float) -> float:
+        """
+        put a frame on the air, returns the time it ends at
+        """
+        with self._cond:
+            # a radio can only send one frame at a time
+            t_start = max(self.now(), sender._tx_busy_until)
+            tr = _Transmission(
+                sender=sender,
+                data=data,
+                frequency=sender._params.get("frequency"),
+                spreading_factor=sender._params.get("spreading_factor"),
+                t_start=t_start,
+                t_end=t_start + airtime,
+            )
+            sender._tx_busy_until = tr.t_end
+            self._transmissions.append(tr)
+            self.stats["transmitted"] += 1
+            self._schedule(tr.t_end, lambda: self._frame_end(tr))
+            return tr.t_end
+
+    def _frame_end(self, tr: _Transmission) -> list:
+        """
+        returns the (node, packet) deliveries for this frame, those are done without holding the lock
+        """
+        deliveries = []
+        interferers = [
+            x for x in self._transmissions
+            if x is not tr
+            and x.frequency == tr.frequency
+            and x.spreading_factor == tr.spreading_factor
+            and x.t_start < tr.t_end
+            and x.t_end > tr.t_start
+        ]
+        for node in self._nodes:
+            if node is tr.sender or not node._receiving or not node._params_match(tr.sender):
+                continue
+            link = self._get_link(tr.sender, node)
+            if link is None:
+                continue
+            # half duplex, we can't hear anything while transmitting
+            if any(x.sender is node for x in interferers):
+                continue
+            snr = link.snr + (self._rng.gauss(0, self._snr_jitter) if self._snr_jitter else 0.0)
+            if snr < demod_snr_limit(tr.spreading_factor):
+                self.stats["weak"] += 1
+                continue
+            collided = False
+            for x in interferers:
+                x_link = self._get_link(x.sender, node)
+                if x_link is not None and link.rssi - x_link.rssi < CAPTURE_THRESHOLD_DB:
+                    collided = True
+                    break
+            if collided:
+                self.stats["collisions"] += 1
+                continue
+            self.stats["received"] += 1
+            deliveries.append((node, lora_modem.LoraPacketReceived(
+                data=tr.data,
+                snr=snr,
+                rssi=link.rssi,
+                freqError=0,
+            )))
+
+        # forget frames that can't overlap anything that is still to come
+        pending = [x for x in self._transmissions if x is not tr and x.t_end >= tr.t_end]
+        t_oldest = min((x.t_start for x in pending), default=float("inf"))
+        self._transmissions = pending + [x for x in self._transmissions if x.t_end < tr.t_end and x.t_end > t_oldest]
+        if tr.t_end > t_oldest:
+            self._transmissions.append(tr)
+        return deliveries
+
+    def run_until(self, t: float) -> None:
+        """
+        simulated time only, process every event up to t and advance the clock to t
+        """
+        if not self._simulated:
+            raise Exception("run_until is only available in simulated time")
+        with self._cond:
+            while self._events and self._events[0][0] <= t:
+                t_ev, _, fn = heapq.heappop(self._events)
+                self._t_sim = t_ev
+                for node, p in fn():
+                    node._deliver(p)
+            self._t_sim = max(self._t_sim, t)
+
+    def run(self) -> None:
+        """
+        simulated time only, process events until nothing is left on the air
+        """
+        if not self._simulated:
+            raise Exception("run is only available in simulated time")
+        with self._cond:
+            while self._events:
+                self.run_until(self._events[0][0])
+
+    def start(self) -> None:
+        if self._simulated:
+            raise Exception("start is only available in real time, use run/run_until")
+
+        def _thread():
+            while True:
+                with self._cond:
+                    if self._thread_stop:
+                        return
+                    if not self._events:
+                        self._cond.wait()
+                        continue
+                    wait = self._events[0][0] - self.now()
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    _, _, fn = heapq.heappop(self._events)
+                    deliveries = fn()
+                for node, p in deliveries:
+                    node._deliver(p)
+
+        self._thread_stop = False
+        self._thread = threading.Thread(target=_thread)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._thread_stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class VirtualLoraModem(lora_modem.LoraModem):
+    """
+    LoraModem attached to a VirtualAir.
+
+    In simulated time tx() puts frames on the air right away (after this node's previous frame) instead of
+    going through the TX scheduler thread, which waits in wall-clock time. Duty cycle tracking uses the air's clock.
+    """
+
+    def __init__(self, air: VirtualAir, name: str | None = None):
+        super().__init__()
+        self.air = air
+        self.name = name
+        self._dt_rx = lora_modem.DutyCycleTracker(60*60, 60, clock=air.now)
+        self._dt_tx = lora_modem.DutyCycleTracker(60*60, 60, clock=air.now)
+        self._params = {}
+        self._rx_cb = None
+        self._receiving = False
+        self._tx_busy_until = 0.0
+        air._add_node(self)
+
+    def __repr__(self):
+        return f"VirtualLoraModem({self.name!r})"
+
+    def _params_match(self, other: "VirtualLoraModem") -> bool:
+        return all(self._params.get(k) == other._params.get(k) for k in ["frequency", "spreading_factor", "bandwidth", "syncword", "invert_iq"])
+
+    def _deliver(self, p: lora_modem.LoraPacketReceived) -> None:
+        try:
+            self._rx_cb(p)
+        except:
+            _logger.exception("rx_cb exception")
+
+    def _start(self, rx_cb):
+        self._rx_cb = rx_cb
+        self._receiving = True
+
+    def _stop(self):
+        self._receiving = False
+        self._rx_cb = None
+
+    def tx(self, p: lora_modem.LoraPacket, priority: lora_modem.TxPriority = lora_modem.TxPriority.OWN) -> concurrent.futures.Future:
+        if not self.air._simulated:
+            return super().tx(p, priority)
+        future = concurrent.futures.Future()
+        airtime = self._calc_airtime(p)
+        self._dt_tx.report(airtime)
+        self.air.transmit(self, bytes(p.data), airtime)
+        future.set_result(lora_modem.TxResult(success=True))
+        return future
+
+    def supports_per_frame_tx_params(self) -> bool:
+        # TX power isn't modelled, links are fixed
+        return True
+
+    def _tx(self, p: lora_modem.LoraPacket):
+        self.air.transmit(self, bytes(p.data), self._calc_airtime(p))
+
+    def _set_lora_params(self, params):
+        self._params.update(params)